@@ -35,6 +35,7 @@ def save_config():
         _cfg["app"] = app
         _cfg["whisper"] = whisper
         _cfg["pexels"] = pexels
+        _cfg["encoder"] = encoder
         f.write(toml.dumps(_cfg))
 
 
@@ -43,6 +44,7 @@ app = _cfg.get("app", {})
 whisper = _cfg.get("whisper", {})
 pexels = _cfg.get("pexels", {})
 ui = _cfg.get("ui", {})
+encoder = _cfg.get("encoder", {})
 
 hostname = socket.gethostname()
 
@@ -0,0 +1,56 @@
+from typing import List
+
+from pydantic import BaseModel
+
+
+class EdlClip(BaseModel):
+    source: str
+    start: float = 0  # in point in the source, in seconds
+    end: float = 0  # out point in the source, in seconds
+    slot: float = 0  # start time on the output timeline, in seconds
+
+    @property
+    def duration(self) -> float:
+        return max(self.end - self.start, 0)
+
+
+class EdlOverlay(BaseModel):
+    kind: str = "subtitle"
+    text: str = ""
+    start: float = 0
+    end: float = 0
+
+
+class EdlSubtitleStyle(BaseModel):
+    font_path: str = ""
+    font_size: int = 60
+    fore_color: str = "#FFFFFF"
+    background_color: str = "transparent"
+    stroke_color: str = "#000000"
+    stroke_width: float = 1.5
+    position: str = "bottom"  # top, bottom, center
+
+
+class EdlAudioTrack(BaseModel):
+    kind: str = "voice"  # voice, bgm
+    source: str
+    volume: float = 1.0
+    loop: bool = False
+    fade_out: float = 0  # seconds faded out at the end of the output
+
+
+class Edl(BaseModel):
+    """
+    Edit decision list: everything needed to render a video, without touching any media.
+    """
+    width: int = 1080
+    height: int = 1920
+    fps: int = 30
+    quality: str = "full"
+    encoder_profile: str = ""
+    duration: float = 0
+    clips: List[EdlClip] = []
+    overlays: List[EdlOverlay] = []
+    subtitle_path: str = ""
+    subtitle_style: EdlSubtitleStyle = EdlSubtitleStyle()
+    audio_tracks: List[EdlAudioTrack] = []
@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import Any, Optional
+from typing import Any, List, Optional
 
 from pydantic import BaseModel
 import warnings
@@ -28,12 +28,33 @@ class VideoAspect(str, Enum):
         return 1080, 1920
 
 
+class VideoQuality(str, Enum):
+    preview = "preview"
+    full = "full"
+
+    def to_format(self, width: int, height: int):
+        """
+        Output (width, height, fps) of this quality tier for a full resolution of width x height.
+        """
+        if self == VideoQuality.preview.value:
+            # 480p at 15 fps, keep the sizes even for yuv420p
+            scale = 480 / min(width, height)
+            return int(width * scale) // 2 * 2, int(height * scale) // 2 * 2, 15
+        return width, height, 30
+
+
 class MaterialInfo:
     provider: str = "pexels"
     url: str = ""
     duration: int = 0
 
 
+class MaterialClip:
+    path: str = ""
+    start: float = 0  # in point, in seconds
+    end: float = 0  # out point, in seconds, 0 means the end of the file
+
+
 # VoiceNames = [
 #     # zh-CN
 #     "female-zh-CN-XiaoxiaoNeural",
@@ -91,9 +112,11 @@ class VideoParams:
     video_script: str = ""  # 用于生成视频的脚本
     video_terms: Optional[str | list] = None  # 用于生成视频的关键词
     video_aspect: Optional[VideoAspect] = VideoAspect.landscape.value
+    video_aspects: Optional[List[VideoAspect]] = []  # extra aspects rendered from the same timeline
     video_concat_mode: Optional[VideoConcatMode] = VideoConcatMode.sequential.value
     video_clip_duration: Optional[int] = 5
     video_count: Optional[int] = 1
+    video_quality: Optional[VideoQuality] = VideoQuality.full.value  # preview: fast low resolution draft
 
     video_language: Optional[str] = ""  # auto detect
 
@@ -112,7 +135,8 @@ class VideoParams:
     font_size: int = 60
     stroke_color: Optional[str] = "#000000"
     stroke_width: float = 1.5
-    n_threads: Optional[int] = 2
+    n_threads: Optional[int] = 0  # 0: derived from the CPU cores and the renders running on the node
+    encoder_profile: Optional[str] = ""  # preview, fast, balanced, quality, small, empty: by video_quality and config
     paragraph_number: Optional[int] = 1
 
 
@@ -0,0 +1,112 @@
+import json
+import os
+import tempfile
+from typing import List
+
+import numpy as np
+from loguru import logger
+
+from app.models.edl import Edl, EdlAudioTrack
+from app.services import bgm, mezzanine
+from app.utils import utils, ffmpeg
+
+SAMPLE_RATE = bgm.SAMPLE_RATE
+CHANNELS = bgm.CHANNELS
+
+
+def cache_dir() -> str:
+    return utils.cache_dir("audio_cache_directory", "cache_audio")
+
+
+def tracks_hash(tracks: List[EdlAudioTrack], duration: float) -> str:
+    """
+    Identifies the mixed track: the settings of every track, the sources it reads and the output duration.
+    """
+    inputs = {
+        "duration": round(duration, 3),
+        "sample_rate": SAMPLE_RATE,
+        "tracks": [track.model_dump() for track in tracks],
+        "sources": [mezzanine.source_hash(track.source) for track in tracks],
+    }
+    return utils.md5(json.dumps(inputs, sort_keys=True))
+
+
+def decode(source: str, samples: int) -> np.ndarray:
+    """
+    Exactly `samples` samples of the source as (samples, channels) float32, padded with silence.
+    """
+    # unique per call, the variants of a task decode the same voice at the same time
+    fd, temp_file = tempfile.mkstemp(dir=cache_dir(), prefix="decode-", suffix=".wav")
+    os.close(fd)
+    try:
+        ffmpeg.run(["-i", source, "-vn", "-ac", str(CHANNELS), "-ar", str(SAMPLE_RATE),
+                    "-c:a", "pcm_s16le", temp_file])
+        pcm = bgm.read_wav(temp_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+    output = np.zeros((samples, CHANNELS), dtype=np.float32)
+    n = min(samples, len(pcm))
+    output[:n] = pcm[:n]
+    return output
+
+
+def mix(tracks: List[EdlAudioTrack], duration: float) -> np.ndarray:
+    """
+    Mix the tracks into `duration` seconds of (samples, channels) float32, gain, fades and sum are vectorized.
+    """
+    samples = int(round(duration * SAMPLE_RATE))
+    output = np.zeros((samples, CHANNELS), dtype=np.float32)
+    for track in tracks:
+        if track.loop:
+            # cached normalized loop of the bgm library, volume and fade applied
+            output += bgm.mix(track.source, duration, volume=track.volume, fade_out=track.fade_out)
+            continue
+
+        pcm = decode(track.source, samples)
+        pcm *= np.float32(track.volume)
+        fade = min(int(track.fade_out * SAMPLE_RATE), samples)
+        if fade:
+            pcm[samples - fade:] *= np.linspace(1, 0, fade, dtype=np.float32)[:, None]
+        output += pcm
+    np.clip(output, -1, 1, out=output)
+    return output
+
+
+def render_tracks(tracks: List[EdlAudioTrack], duration: float) -> str:
+    """
+    Render the mixed audio of a video once to AAC, cached by the hash of its inputs,
+    so the video encodes only mux it and video-only re-renders reuse it.
+    """
+    tracks = [track for track in tracks if track.source and os.path.exists(track.source)]
+    if not tracks or duration <= 0:
+        return ""
+
+    key = tracks_hash(tracks, duration)
+    audio_file = os.path.join(cache_dir(), f"audio-{key}.m4a")
+    if os.path.exists(audio_file) and os.path.getsize(audio_file) > 0:
+        logger.info(f"reusing the rendered audio: {audio_file}")
+        return audio_file
+
+    with utils.single_flight(key, lock_file=f"{audio_file}.lock"):
+        if os.path.exists(audio_file) and os.path.getsize(audio_file) > 0:
+            return audio_file
+
+        logger.info(f"rendering audio, {len(tracks)} tracks, duration: {duration:.2f}s => {audio_file}")
+        wav_file = audio_file.replace(".m4a", ".part.wav")
+        temp_file = audio_file.replace(".m4a", ".part.m4a")
+        try:
+            bgm.write_wav(wav_file, mix(tracks, duration))
+            ffmpeg.run(["-i", wav_file, "-c:a", "aac", "-b:a", "192k", temp_file])
+            os.replace(temp_file, audio_file)
+        finally:
+            for f in (wav_file, temp_file):
+                if os.path.exists(f):
+                    os.remove(f)
+
+    return audio_file
+
+
+def render(edl: Edl) -> str:
+    return render_tracks(edl.audio_tracks, edl.duration)
@@ -0,0 +1,247 @@
+import glob
+import json
+import os
+import threading
+import wave
+from functools import lru_cache
+from typing import List
+
+import numpy as np
+from loguru import logger
+
+from app.config import config
+from app.utils import utils, ffmpeg
+
+# every loop of the library has the same format, so they can be mixed without resampling
+SAMPLE_RATE = 44100
+CHANNELS = 2
+
+_index = None  # song file => analysis, see _analyze()
+_index_lock = threading.Lock()
+_warm_up_started = False
+_songs = None  # (mtime of the song directory, song files)
+
+
+def cache_dir() -> str:
+    return utils.cache_dir("bgm_cache_directory", "cache_bgm")
+
+
+def _index_file() -> str:
+    return os.path.join(cache_dir(), "index.json")
+
+
+def _target_loudness() -> float:
+    return float(config.app.get("bgm_loudness", -20))
+
+
+def read_wav(wav_file: str) -> np.ndarray:
+    with wave.open(wav_file, "rb") as f:
+        frames = f.readframes(f.getnframes())
+        channels = f.getnchannels()
+    return np.frombuffer(frames, dtype=np.int16).reshape(-1, channels).astype(np.float32) / 32768
+
+
+def write_wav(wav_file: str, samples: np.ndarray):
+    pcm = (np.clip(samples, -1, 1) * 32767).astype(np.int16)
+    with wave.open(wav_file, "wb") as f:
+        f.setnchannels(pcm.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes(pcm.tobytes())
+
+
+def _analyze(song_file: str, loop_file: str) -> dict:
+    """
+    Decode a song once, measure it and write a loudness normalized loop that can be repeated without a click.
+    """
+    temp_file = f"{loop_file}.part.wav"
+    try:
+        ffmpeg.run(["-i", song_file, "-vn", "-ac", str(CHANNELS), "-ar", str(SAMPLE_RATE),
+                    "-c:a", "pcm_s16le", temp_file])
+        samples = read_wav(temp_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+    # RMS level in dBFS, close enough to LUFS to even out the songs of the library
+    rms = float(np.sqrt(np.mean(np.square(samples, dtype=np.float64)))) if len(samples) else 0.
+    loudness = 20 * np.log10(rms) if rms > 0 else -100.
+    peak = float(np.max(np.abs(samples))) if len(samples) else 0.
+    gain = 10 ** ((_target_loudness() - loudness) / 20) if rms > 0 else 1.
+    if peak > 0:
+        gain = min(gain, 1 / peak)
+
+    # crossfade the tail into the head, so the end of the loop runs into its start seamlessly
+    fade = min(int(SAMPLE_RATE * 0.5), len(samples) // 4)
+    loop = samples * gain
+    if fade:
+        ramp = np.linspace(0, 1, fade, dtype=np.float32)[:, None]
+        loop = np.concatenate([loop[fade:-fade], loop[-fade:] * (1 - ramp) + loop[:fade] * ramp])
+    # replaced, never rewritten in place: the previous loop may still be memory-mapped, see _load_loop()
+    temp_loop_file = f"{loop_file}.part.loop.wav"
+    try:
+        write_wav(temp_loop_file, loop)
+        os.replace(temp_loop_file, loop_file)
+    finally:
+        if os.path.exists(temp_loop_file):
+            os.remove(temp_loop_file)
+
+    stat = os.stat(song_file)
+    return {
+        "file": song_file,
+        "size": stat.st_size,
+        "mtime": int(stat.st_mtime),
+        "duration": len(samples) / SAMPLE_RATE,
+        "sample_rate": SAMPLE_RATE,
+        "loudness": round(loudness, 2),
+        "gain": round(float(gain), 4),
+        "loop": loop_file,
+        "loop_duration": len(loop) / SAMPLE_RATE,
+    }
+
+
+def _is_fresh(entry: dict, song_file: str) -> bool:
+    if not entry or not os.path.exists(entry.get("loop", "")):
+        return False
+    stat = os.stat(song_file)
+    return entry.get("size") == stat.st_size and entry.get("mtime") == int(stat.st_mtime)
+
+
+def _read_index() -> dict:
+    if not os.path.exists(_index_file()):
+        return {}
+    try:
+        with open(_index_file(), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"failed to load bgm index, rebuild it: {str(e)}")
+        return {}
+
+
+def _load_index(reload: bool = False) -> dict:
+    # the index of this process, `reload` picks up the songs analyzed by the other processes
+    global _index
+    with _index_lock:
+        if _index is None or reload:
+            _index = _read_index()
+        return _index
+
+
+def _save_entry(song_file: str, entry: dict):
+    """
+    Add an entry to index.json, merged with the entries the other processes saved meanwhile.
+    """
+    global _index
+    with utils.single_flight(_index_file(), lock_file=f"{_index_file()}.lock"):
+        tracks = _read_index()
+        tracks[song_file] = entry
+        temp_file = f"{_index_file()}.part"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(tracks, f, ensure_ascii=False, indent=2)
+        os.replace(temp_file, _index_file())
+    with _index_lock:
+        _index = tracks
+
+
+def get_entry(song_file: str) -> dict:
+    """
+    The analysis of a song of the library, the song is only decoded when it is new or changed.
+    """
+    entry = _load_index().get(song_file)
+    if _is_fresh(entry, song_file):
+        return entry
+
+    loop_file = os.path.join(cache_dir(), f"loop-{utils.md5(song_file)}.wav")
+    with utils.single_flight(loop_file, lock_file=f"{loop_file}.lock"):
+        # another process may have analyzed it while this one waited for the lock
+        entry = _load_index(reload=True).get(song_file)
+        if _is_fresh(entry, song_file):
+            return entry
+        logger.info(f"analyzing bgm: {song_file}")
+        entry = _analyze(song_file, loop_file)
+        _save_entry(song_file, entry)
+    return entry
+
+
+def list_songs() -> List[str]:
+    """
+    The songs of the library, listed again only when resource/songs changes.
+    The songs are analyzed when they are picked, or ahead of time by warm_up().
+    """
+    global _songs
+    song_dir = utils.song_dir()
+    dir_mtime = os.stat(song_dir).st_mtime
+    with _index_lock:
+        if _songs is not None and _songs[0] == dir_mtime:
+            return list(_songs[1])
+    songs = sorted(glob.glob(os.path.join(song_dir, "*.mp3")))
+    with _index_lock:
+        _songs = (dir_mtime, songs)
+    return list(songs)
+
+
+def warm_up():
+    """
+    Analyze the songs of the library in a background thread, off the path of the tasks. Started once per process.
+    """
+    global _warm_up_started
+    with _index_lock:
+        if _warm_up_started:
+            return
+        _warm_up_started = True
+
+    def analyze_all():
+        for song_file in list_songs():
+            try:
+                get_entry(song_file)
+            except Exception as e:
+                logger.error(f"failed to analyze bgm: {song_file} => {str(e)}")
+
+    threading.Thread(target=analyze_all, name="bgm-warm-up", daemon=True).start()
+
+
+def get_loop_file(song_file: str) -> str:
+    """
+    The normalized loop of a song, analyzed on the first use.
+    """
+    if os.path.dirname(os.path.abspath(song_file)) == os.path.abspath(cache_dir()):
+        # already a loop, e.g. the bgm track of an EDL
+        return song_file
+    return get_entry(song_file)["loop"]
+
+
+@lru_cache(maxsize=4)
+def _load_loop(loop_file: str, mtime: float) -> np.ndarray:
+    # int16 samples mapped from the file, the pages are shared and only 1/2 of float32 when resident
+    with wave.open(loop_file, "rb") as f:
+        channels = f.getnchannels()
+        frames = f.getnframes()
+    # the loops are written by write_wav(), the samples run to the end of the file
+    offset = os.path.getsize(loop_file) - frames * channels * 2
+    return np.memmap(loop_file, dtype=np.int16, mode="r", offset=offset, shape=(frames, channels))
+
+
+def load_loop(song_file: str) -> np.ndarray:
+    loop_file = get_loop_file(song_file)
+    return _load_loop(loop_file, os.path.getmtime(loop_file))
+
+
+def mix(song_file: str, duration: float, volume: float = 1.0, fade_out: float = 0) -> np.ndarray:
+    """
+    `duration` seconds of the looped song as (samples, channels) float32 at SAMPLE_RATE,
+    with the volume and the fade out applied.
+    """
+    loop = load_loop(song_file)
+    n = int(round(duration * SAMPLE_RATE))
+    # whole repeats of the loop then the partial one, converted straight into the output
+    if not len(loop):
+        return np.zeros((n, CHANNELS), dtype=np.float32)
+    samples = np.empty((n, loop.shape[1]), dtype=np.float32)
+    for offset in range(0, n, len(loop)):
+        count = min(len(loop), n - offset)
+        samples[offset:offset + count] = loop[:count]
+    samples *= np.float32(volume / 32768)
+    fade = min(int(fade_out * SAMPLE_RATE), n)
+    if fade:
+        samples[n - fade:] *= np.linspace(1, 0, fade, dtype=np.float32)[:, None]
+    return samples
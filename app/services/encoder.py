@@ -0,0 +1,93 @@
+import os
+from contextlib import contextmanager
+
+from app.config import config
+from app.models.schema import VideoQuality
+from app.services import shared
+
+# named encoder profiles, can be overridden or extended in the [encoder.profiles] section of config.toml
+PROFILES = {
+    "preview": {"codec": "libx264", "preset": "ultrafast", "crf": 30, "tune": "fastdecode", "keyint": 30,
+                "pix_fmt": "yuv420p"},
+    "fast": {"codec": "libx264", "preset": "veryfast", "crf": 23, "tune": "", "keyint": 60, "pix_fmt": "yuv420p"},
+    "balanced": {"codec": "libx264", "preset": "medium", "crf": 23, "tune": "", "keyint": 60, "pix_fmt": "yuv420p"},
+    "quality": {"codec": "libx264", "preset": "slow", "crf": 18, "tune": "film", "keyint": 60, "pix_fmt": "yuv420p"},
+    "small": {"codec": "libx264", "preset": "slow", "crf": 28, "tune": "", "keyint": 120, "pix_fmt": "yuv420p"},
+}
+
+# the renders running on the node, counted across its processes, see shared.Leases
+_active_renders = shared.Leases("encoder:renders", ttl=6 * 3600)
+
+
+def get_profile_name(profile: str = "", video_quality: VideoQuality = VideoQuality.full) -> str:
+    if profile:
+        return profile
+    if video_quality == VideoQuality.preview.value:
+        return "preview"
+    return config.encoder.get("profile", "balanced")
+
+
+def get_profile(profile: str = "", video_quality: VideoQuality = VideoQuality.full) -> dict:
+    name = get_profile_name(profile, video_quality)
+    settings = dict(PROFILES.get(name, PROFILES["balanced"]))
+    settings.update(config.encoder.get("profiles", {}).get(name, {}))
+    return settings
+
+
+@contextmanager
+def render_slot():
+    """
+    Marks a render running on this node, the thread counts are shared between the running renders
+    of all the processes of the node.
+    """
+    with _active_renders.hold():
+        yield
+
+
+def get_cpu_count() -> int:
+    """
+    The cores the encodes may use: `[encoder] cpu_count`, or the cores this process is allowed to run on.
+    """
+    cpu_count = config.encoder.get("cpu_count", 0)
+    if cpu_count:
+        return cpu_count
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+
+def get_threads(encoders: int = 1) -> int:
+    """
+    Threads for each of `encoders` encodes of this render, so that the renders running on the node
+    do not oversubscribe the CPU cores.
+    """
+    cpu_count = get_cpu_count()
+    renders = max(_active_renders.count(), 1)
+    threads = cpu_count // (renders * max(encoders, 1))
+    max_threads = config.encoder.get("max_threads", 16)
+    return max(1, min(threads, max_threads))
+
+
+def ffmpeg_args(profile: dict, threads: int) -> list:
+    args = ["-c:v", profile["codec"], "-preset", profile["preset"], "-crf", str(profile["crf"])]
+    if profile.get("tune"):
+        args += ["-tune", profile["tune"]]
+    if profile.get("keyint"):
+        args += ["-g", str(profile["keyint"])]
+    args += ["-pix_fmt", profile.get("pix_fmt", "yuv420p"), "-threads", str(threads)]
+    return args
+
+
+def moviepy_args(profile: dict, threads: int) -> dict:
+    # keyword arguments of write_videofile
+    ffmpeg_params = ["-crf", str(profile["crf"]), "-pix_fmt", profile.get("pix_fmt", "yuv420p")]
+    if profile.get("tune"):
+        ffmpeg_params += ["-tune", profile["tune"]]
+    if profile.get("keyint"):
+        ffmpeg_params += ["-g", str(profile["keyint"])]
+    return {
+        "codec": profile["codec"],
+        "preset": profile["preset"],
+        "threads": threads,
+        "ffmpeg_params": ffmpeg_params,
+    }
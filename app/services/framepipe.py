@@ -0,0 +1,188 @@
+import queue
+import subprocess
+import threading
+
+import numpy as np
+from loguru import logger
+
+from app.config import config
+from app.models.edl import Edl
+from app.services import audio, encoder, overlay, render, textrender
+from app.services.progress import RenderReporter
+from app.utils import ffmpeg
+
+
+def subtitle_track(edl: Edl) -> overlay.OverlayTrack:
+    """
+    The subtitles of the EDL as overlays, laid out like the moviepy backend does.
+    """
+    track = overlay.OverlayTrack()
+    style = edl.subtitle_style
+    if not style.font_path:
+        return track
+    for item in edl.overlays:
+        if item.kind != "subtitle" or not item.text.strip():
+            continue
+        lines, _ = textrender.layout(item.text, max_width=edl.width * 0.9, font_path=style.font_path,
+                                     font_size=style.font_size)
+        rgba = textrender.render_text("\n".join(lines).strip(),
+                                      font_path=style.font_path,
+                                      font_size=style.font_size,
+                                      fore_color=style.fore_color,
+                                      background_color=style.background_color,
+                                      stroke_color=style.stroke_color,
+                                      stroke_width=style.stroke_width,
+                                      )
+        txt_h, txt_w = rgba.shape[:2]
+        x = (edl.width - txt_w) / 2
+        if style.position == "bottom":
+            y = edl.height * 0.95 - txt_h
+        elif style.position == "top":
+            y = edl.height * 0.1
+        else:
+            y = (edl.height - txt_h) / 2
+        track.add(rgba, x=x, y=y, start=item.start, end=item.end)
+    return track
+
+
+class FrameRing:
+    """
+    A fixed set of frame buffers allocated once: the decoder fills free buffers, the encoder hands them back,
+    no frame is allocated while rendering.
+    """
+
+    def __init__(self, width: int, height: int, size: int):
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        for _ in range(max(size, 2)):
+            self._free.put(np.empty((height, width, 3), dtype=np.uint8))
+
+    def acquire(self, stop: threading.Event):
+        # None once the pipeline is stopped
+        while not stop.is_set():
+            try:
+                return self._free.get(timeout=0.2)
+            except queue.Empty:
+                pass
+        return None
+
+    def release(self, frame: np.ndarray):
+        self._free.put(frame)
+
+    def push(self, frame):
+        # None marks the end of the stream, an exception a failed decode
+        self._filled.put(frame)
+
+    def pop(self):
+        return self._filled.get()
+
+
+def _read_frame(stream, frame: np.ndarray) -> bool:
+    view = memoryview(frame).cast("B")
+    filled = 0
+    while filled < len(view):
+        n = stream.readinto(view[filled:])
+        if not n:
+            return False
+        filled += n
+    return True
+
+
+def _decode(edl: Edl, ring: FrameRing, stop: threading.Event):
+    """
+    Decode the clips one after another, ffmpeg does the scale/pad/fps conversion and writes raw rgb24 frames
+    straight into the buffers of the ring.
+    """
+    try:
+        for clip in edl.clips:
+            # exactly the planned frames of the clip, a short source repeats its last frame,
+            # so the errors of the fps conversion don't add up along the timeline
+            video_filter = render.normalize_filter(edl, pix_fmt="rgb24", source=clip.source)
+            video_filter += ",tpad=stop=-1:stop_mode=clone"
+            process = ffmpeg.popen(["-ss", f"{clip.start:.3f}", "-t", f"{clip.duration:.3f}", "-i", clip.source,
+                                    "-an", "-vf", video_filter, "-frames:v", str(render.clip_frames(edl, clip)),
+                                    "-f", "rawvideo", "-pix_fmt", "rgb24", "pipe:1"],
+                                   stdout=subprocess.PIPE)
+            try:
+                while True:
+                    frame = ring.acquire(stop)
+                    if frame is None:
+                        break
+                    if not _read_frame(process.stdout, frame):
+                        ring.release(frame)
+                        break
+                    ring.push(frame)
+            finally:
+                if stop.is_set():
+                    process.kill()
+                process.stdout.close()
+                ffmpeg.wait(process)
+            if stop.is_set():
+                return
+        ring.push(None)
+    except Exception as e:
+        ring.push(e)
+
+
+def render_video(edl: Edl, output_file: str, threads: int = 0, reporter: RenderReporter = None,
+                 progressive: bool = True) -> str:
+    """
+    Render the EDL through a pipeline of raw frames: ffmpeg decoders => ring of preallocated buffers =>
+    subtitles blended in place => ffmpeg encoder. The frames never leave the ring, so nothing is allocated
+    per frame, unlike the moviepy backend.
+    """
+    track = subtitle_track(edl)
+    audio_file = audio.render(edl)
+    ring = FrameRing(edl.width, edl.height, config.app.get("frame_buffers", 8))
+
+    args = ["-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{edl.width}x{edl.height}", "-r", str(edl.fps),
+            "-i", "pipe:0"]
+    if audio_file:
+        args += ["-i", audio_file, "-map", "0:v", "-map", "1:a", "-c:a", "copy"]
+    args += ["-t", f"{edl.duration:.3f}",
+             *encoder.ffmpeg_args(render.get_profile(edl), threads or encoder.get_threads()),
+             *render.output_args(output_file, progressive)]
+
+    logger.info(f"rendering {len(edl.clips)} clips through the frame pipeline, "
+                f"{len(track)} overlays, duration: {edl.duration:.2f}s => {output_file}")
+    process = ffmpeg.popen(args, stdin=subprocess.PIPE)
+    stop = threading.Event()
+    decoder = threading.Thread(target=_decode, args=(edl, ring, stop), daemon=True)
+    decoder.start()
+
+    # the encoder exits at the duration, a frame more would break its pipe
+    total_frames = round(edl.duration * edl.fps)
+    index = 0
+    try:
+        while index < total_frames:
+            frame = ring.pop()
+            if frame is None:
+                break
+            if isinstance(frame, Exception):
+                raise frame
+            try:
+                # the buffer is writable, the subtitles are blended into it in place
+                track.composite(frame, index / edl.fps)
+                process.stdin.write(memoryview(frame).cast("B"))
+            finally:
+                ring.release(frame)
+            index += 1
+            if reporter:
+                reporter.update(index)
+    except Exception as e:
+        # stop the decoder, it may be waiting for a free buffer
+        stop.set()
+        decoder.join()
+        process.kill()
+        err = process.stderr.read().decode("utf-8", errors="ignore").strip()
+        process.wait()
+        raise RuntimeError(f"frame pipeline failed: {str(e)} {err}") from e
+
+    # the decoder may still be running when the frames of the duration are all written
+    stop.set()
+    decoder.join()
+    ffmpeg.wait(process)
+    render.finish_output(output_file, progressive)
+
+    logger.success(f"completed, {index} frames")
+    return output_file
@@ -1,5 +1,7 @@
 import logging
+import os
 import re
+import threading
 import json
 from typing import List
 from loguru import logger
@@ -8,6 +10,7 @@ from openai import AzureOpenAI
 from openai.types.chat import ChatCompletion
 
 from app.config import config
+from app.utils import utils
 
 
 def _generate_response(prompt: str) -> str:
@@ -297,7 +300,35 @@ Generate {amount} search terms for stock videos, depending on the subject of a v
     return search_terms
 
 
+def _prompt_cache_file(subject: str, script: str) -> str:
+    d = utils.cache_dir("prompt_cache_directory", "cache_prompts")
+    return os.path.join(d, f"prompt-{utils.md5(json.dumps([subject, script], ensure_ascii=False))}.txt")
+
+
 def generate_prompt(subject: str, script: str) -> List[str]:
+    """
+    The search prompt of one line of the script. The responses are not deterministic, so they are cached by
+    (subject, line): a re-render of an edited script gets the same clips, hence the same cached segments,
+    for the lines that didn't change.
+    """
+    cache_file = _prompt_cache_file(subject, script) if config.app.get("prompt_cache", True) else ""
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, "r", encoding="utf-8") as f:
+            response = f.read()
+        if response:
+            logger.info(f"reusing the prompt of: {script}")
+            return response
+
+    response = _generate_prompt(subject, script)
+    if cache_file and response:
+        temp_file = f"{cache_file}.{os.getpid()}-{threading.get_ident()}.part"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            f.write(response)
+        os.replace(temp_file, cache_file)
+    return response
+
+
+def _generate_prompt(subject: str, script: str) -> List[str]:
     prompt = f"""
 # Role: Prompt Generator for CLIP model
 
@@ -1,20 +1,35 @@
 import os
 import random
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlencode
 
 import requests
 from typing import List
 from loguru import logger
-from moviepy.video.io.VideoFileClip import VideoFileClip
 
 from app.config import config
-from app.models.schema import VideoAspect, VideoConcatMode, MaterialInfo
-from app.utils import utils
+from app.models.schema import VideoAspect, VideoConcatMode, MaterialInfo, MaterialClip
+from app.utils import utils, ffmpeg
+from app.services import encoder, ratelimit, readers, scratch
 from app.services.search import process_text, search_pexels_video_by_feature
 
 requested_count = 0
 
 
+def get_video_url(sampled_video: dict) -> str:
+    return 'https://www.pexels.com/download/video/' + sampled_video["thumbnail_loc"].split('/')[4]
+
+
+def get_material_directory(task_id: str) -> str:
+    material_directory = config.app.get("material_directory", "").strip()
+    if material_directory == "task":
+        # not shared with other tasks, transient
+        material_directory = scratch.task_dir(task_id)
+    elif material_directory and not os.path.isdir(material_directory):
+        material_directory = ""
+    return material_directory
+
+
 def search_videos(search_term: str,
                   duration: float,
                   video_aspect: VideoAspect = VideoAspect.portrait,
@@ -34,7 +49,7 @@ def search_videos(search_term: str,
         
         item = MaterialInfo()
         item.provider = "pexels"
-        item.url = 'https://www.pexels.com/download/video/' + sampled_video["thumbnail_loc"].split('/')[4]
+        item.url = get_video_url(sampled_video)
         item.duration = sampled_video["duration"]
         video_items.append(item)
         
@@ -61,85 +76,193 @@ def save_video(video_url: str, save_dir: str = "") -> str:
         logger.info(f"video already exists: {video_path}")
         return video_path
 
-    # if video does not exist, download it
-    proxies = config.pexels.get("proxies", None)
-    with open(video_path, "wb") as f:
-        f.write(requests.get(video_url, proxies=proxies, verify=False, timeout=(60, 240)).content)
+    # only the first requester downloads, the others wait for it and reuse the file
+    with utils.single_flight(video_id, lock_file=f"{video_path}.lock"):
+        if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
+            logger.info(f"video downloaded by another task: {video_path}")
+            return video_path
+
+        # if video does not exist, download it to a temp file, so no one can read a half-written file
+        temp_path = f"{save_dir}/{video_id}.part.mp4"
+        proxies = config.pexels.get("proxies", None)
+        limiter = ratelimit.get_limiter(video_url)
+        with limiter.request():
+            with requests.get(video_url, proxies=proxies, verify=False, timeout=(60, 240), stream=True) as r:
+                with open(temp_path, "wb") as f:
+                    for chunk in r.iter_content(chunk_size=256 * 1024):
+                        limiter.consume(len(chunk))
+                        f.write(chunk)
+
+        if os.path.exists(temp_path) and os.path.getsize(temp_path) > 0:
+            try:
+                # only the header is read, no reader is kept open
+                info = ffmpeg.probe(temp_path)
+                duration = info["duration"]
+                fps = info["fps"]
+                if duration > 0 and fps > 0:
+                    os.replace(temp_path, video_path)
+                    return video_path
+            except Exception as e:
+                logger.warning(f"invalid video file: {video_path} => {str(e)}")
 
-    if os.path.exists(video_path) and os.path.getsize(video_path) > 0:
         try:
-            clip = VideoFileClip(video_path)
-            duration = clip.duration
-            fps = clip.fps
-            clip.close()
-            if duration > 0 and fps > 0:
-                return video_path
+            os.remove(temp_path)
         except Exception as e:
+            pass
+    return ""
+
+
+def trim_video(video_path: str, duration: float, end: float, trim_mode: str = "reference") -> MaterialClip:
+    """
+    Keep [0, end] of a downloaded video, `duration` is the length of the whole file.
+
+    trim_mode:
+      - reference: no file is written, the out point is recorded and applied by the renderer
+      - copy: cut with stream copy, the in point is always 0 (a keyframe), so no re-encoding is needed
+      - encode: decode and re-encode the trimmed clip (legacy behaviour)
+    """
+    clip = MaterialClip()
+    clip.path = video_path
+    clip.start = 0
+    clip.end = end if end < duration else 0
+
+    if trim_mode == "reference" or not clip.end:
+        return clip
+
+    post_str = os.path.splitext(video_path)[-1]
+    clip_path = video_path.replace(post_str, f"_clip-{int(end * 1000)}{post_str}")
+    with utils.single_flight(clip_path, lock_file=f"{clip_path}.lock"):
+        if not (os.path.exists(clip_path) and os.path.getsize(clip_path) > 0):
+            # written under a temporary name, a half-written clip is never read nor kept
+            temp_path = f"{os.path.splitext(clip_path)[0]}.part{post_str}"
             try:
-                os.remove(video_path)
+                if trim_mode == "copy":
+                    ffmpeg.run(["-i", video_path, "-t", f"{end:.3f}", "-map", "0:v:0", "-c", "copy", "-an",
+                                "-movflags", "+faststart", temp_path])
+                else:
+                    with readers.open_clip(video_path) as cur_clip:
+                        # keep the frame rate of the source, the renderer converts it once if needed
+                        source_fps = cur_clip.fps or 30
+                        cur_clip = cur_clip.subclip(0, end)
+                        cur_clip.write_videofile(
+                            filename=temp_path,
+                            logger=None,
+                            audio_codec="aac",
+                            fps=source_fps,
+                            **encoder.moviepy_args(encoder.get_profile("fast"), encoder.get_threads()),
+                        )
+                os.replace(temp_path, clip_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    clip.path = clip_path
+    clip.end = 0
+    return clip
+
+
+class Prefetcher:
+    """
+    Searches the materials of each segment as soon as its prompt is generated and downloads the top
+    candidates in the background, so the LLM calls of later segments overlap with the network.
+    download_videos() then finds the videos in the cache, or waits for the running downloads.
+    """
+
+    def __init__(self, task_id: str):
+        self.material_directory = get_material_directory(task_id)
+        # the search model runs on one thread, downloads are bounded by the rate limiter
+        self._search_pool = ThreadPoolExecutor(max_workers=1)
+        self._download_pool = ThreadPoolExecutor(max_workers=config.app.get("prefetch_workers", 4))
+        self._searches = {}
+
+    def submit(self, search_term: str, duration: float):
+        if search_term not in self._searches:
+            self._searches[search_term] = self._search_pool.submit(self._search, search_term, duration)
+
+    def _search(self, search_term: str, duration: float) -> list:
+        video_list = search_pexels_video_by_feature(process_text(search_term))
+        sampled_duration = 0.
+        for sampled_video in video_list:
+            if sampled_duration >= duration:
+                break
+            self._download_pool.submit(self._download, get_video_url(sampled_video))
+            sampled_duration += sampled_video["duration"]
+        return video_list
+
+    def _download(self, video_url: str):
+        try:
+            save_video(video_url=video_url, save_dir=self.material_directory)
+        except Exception as e:
+            logger.warning(f"failed to prefetch video: {video_url} => {str(e)}")
+
+    def search_results(self) -> dict:
+        results = {}
+        for search_term, future in self._searches.items():
+            try:
+                results[search_term] = future.result()
             except Exception as e:
-                pass
-            logger.warning(f"invalid video file: {video_path} => {str(e)}")
-    return ""
+                logger.warning(f"failed to search videos for '{search_term}': {str(e)}")
+        return results
+
+    def shutdown(self):
+        self._search_pool.shutdown(wait=False, cancel_futures=True)
+        self._download_pool.shutdown(wait=False, cancel_futures=True)
 
 
 def download_videos(task_id: str,
                     search_terms: List = [(str, float)],
                     video_aspect: VideoAspect = VideoAspect.portrait,
-                    ) -> List[str]:
-    video_paths = []
+                    search_results: dict = None,
+                    variant: int = 0,
+                    ) -> List[MaterialClip]:
+    """
+    Download the clips of each search term. Variant n starts from the n-th best candidate of each term,
+    so the variants of a task get other clips from the same search results and downloads.
+    """
+    video_clips = []
     valid_video_urls = []
+    search_results = search_results or {}
     
-    material_directory = config.app.get("material_directory", "").strip()
-    if material_directory == "task":
-        material_directory = utils.task_dir(task_id)
-    elif material_directory and not os.path.isdir(material_directory):
-        material_directory = ""
+    material_directory = get_material_directory(task_id)
+
+    trim_mode = config.app.get("clip_trim_mode", "reference").strip().lower()
     
     for search_term in search_terms:
         logger.info(f"searching videos for '{search_term}'")
         
-        text_feature = process_text(search_term[0])
-        video_list = search_pexels_video_by_feature(text_feature)
+        video_list = search_results.get(search_term[0])
+        if video_list is None:
+            text_feature = process_text(search_term[0])
+            video_list = search_pexels_video_by_feature(text_feature)
         
         cur_sampled_duration = 0.
         idx = 0
         
-        while cur_sampled_duration < search_term[1]:
-            sampled_video = video_list[idx]
-            cur_url = 'https://www.pexels.com/download/video/' + sampled_video["thumbnail_loc"].split('/')[4]
+        while cur_sampled_duration < search_term[1] and idx < len(video_list):
+            sampled_video = video_list[(idx + variant) % len(video_list)]
+            cur_url = get_video_url(sampled_video)
             
             if cur_url not in valid_video_urls:
                 logger.info(f"downloading video: {cur_url}")
                 saved_video_path = save_video(video_url=cur_url, save_dir=material_directory)
                 
                 if saved_video_path:
-                    cur_clip = VideoFileClip(saved_video_path).without_audio()
-                    cur_clip = cur_clip.set_fps(30)
-                    
-                    if (cur_sampled_duration + cur_clip.duration) > search_term[1]:
-                        cur_clip = cur_clip.subclip(0, (search_term[1] - cur_sampled_duration + 0.2))
-                    
-                    post_str = os.path.splitext(saved_video_path)[-1]
-                    saved_video_clip_path = saved_video_path.replace(post_str, '_clip' + post_str)
-                    
-                    cur_clip.write_videofile(
-                            filename=saved_video_clip_path,
-                            threads=2,
-                            logger=None,
-                            audio_codec="aac",
-                            fps=30,
-                        )
-                    
-                    logger.info(f"video saved: {saved_video_clip_path}")
-                    video_paths.append(saved_video_clip_path)
+                    clip_duration = ffmpeg.probe(saved_video_path)["duration"]
+
+                    clip_end = clip_duration
+                    if (cur_sampled_duration + clip_duration) > search_term[1]:
+                        clip_end = min(clip_duration, search_term[1] - cur_sampled_duration + 0.2)
+
+                    video_clip = trim_video(saved_video_path, clip_duration, clip_end, trim_mode)
+                    logger.info(f"video saved: {video_clip.path}, out point: {video_clip.end}")
+                    video_clips.append(video_clip)
                     
-                    cur_sampled_duration += cur_clip.duration
+                    cur_sampled_duration += clip_end
                     valid_video_urls.append(cur_url)
             idx += 1
 
-    logger.success(f"downloaded {len(video_paths)} videos")
-    return video_paths
+    logger.success(f"downloaded {len(video_clips)} videos")
+    return video_clips
 
 
 if __name__ == "__main__":
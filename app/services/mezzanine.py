@@ -0,0 +1,59 @@
+import os
+
+from loguru import logger
+
+from app.services import encoder
+from app.utils import utils, ffmpeg
+
+
+def cache_dir() -> str:
+    return utils.cache_dir("mezzanine_directory", "cache_mezzanine")
+
+
+def source_hash(video_path: str) -> str:
+    # hashing the content of every clip is too slow, path + size + mtime identifies a downloaded file well enough
+    stat = os.stat(video_path)
+    return utils.md5(f"{os.path.abspath(video_path)}:{stat.st_size}:{int(stat.st_mtime)}")
+
+
+def get_normalized_video(video_path: str, width: int, height: int, fps: int = 30) -> str:
+    """
+    Return a copy of `video_path` already scaled and letterboxed to width x height at `fps`,
+    it is produced once with ffmpeg and shared by every later task with the same target format.
+    A video already in the target format is returned as is.
+    """
+    convert = ffmpeg.negotiate(video_path, width, height, fps)
+    if not any(convert.values()) and ffmpeg.probe(video_path)["codec"] == "h264":
+        return video_path
+
+    key = f"{source_hash(video_path)}-{width}x{height}-{fps}"
+    normalized_path = os.path.join(cache_dir(), f"mez-{key}.mp4")
+    if os.path.exists(normalized_path) and os.path.getsize(normalized_path) > 0:
+        return normalized_path
+
+    with utils.single_flight(key, lock_file=f"{normalized_path}.lock"):
+        if os.path.exists(normalized_path) and os.path.getsize(normalized_path) > 0:
+            return normalized_path
+
+        logger.info(f"normalizing video to {width} x {height} @ {fps}fps: {video_path}")
+        temp_path = normalized_path.replace(".mp4", ".part.mp4")
+        # only the conversions the source needs
+        filters = []
+        if convert["scale"]:
+            filters += [f"scale={width}:{height}:force_original_aspect_ratio=decrease",
+                        f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2:color=black"]
+        filters.append("setsar=1")
+        if convert["fps"]:
+            filters.append(f"fps={fps}")
+        vf = ",".join(filters)
+        try:
+            ffmpeg.run(["-i", video_path, "-map", "0:v:0", "-an", "-vf", vf,
+                        "-c:v", "libx264", "-preset", "veryfast", "-crf", "18", "-pix_fmt", "yuv420p",
+                        "-threads", str(encoder.get_threads()),
+                        "-movflags", "+faststart", temp_path])
+            os.replace(temp_path, normalized_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    return normalized_path
@@ -0,0 +1,113 @@
+import bisect
+from typing import List
+
+import numpy as np
+
+
+class Overlay:
+    """
+    An RGBA image shown at (x, y) of the frame during [start, end). Its float32 alpha blending terms
+    only exist while it is on screen, see prepare() and release().
+    """
+
+    def __init__(self, rgba: np.ndarray, x: int, y: int, start: float, end: float):
+        self.x = int(x)
+        self.y = int(y)
+        self.start = start
+        self.end = end
+        self.height, self.width = rgba.shape[:2]
+        self.rgba = rgba
+        self.inv_alpha = None
+        self.premultiplied = None
+        self._scratch = None
+
+    def prepare(self):
+        if self.premultiplied is not None:
+            return
+        alpha = self.rgba[:, :, 3:4].astype(np.float32) / 255.0
+        self.inv_alpha = 1.0 - alpha
+        # + 0.5 so the truncation to uint8 rounds
+        self.premultiplied = self.rgba[:, :, :3].astype(np.float32) * alpha + 0.5
+        # the blend is computed in place, so no frame allocates
+        self._scratch = np.empty((self.height, self.width, 3), dtype=np.float32)
+
+    def release(self):
+        # 16 bytes per pixel, dropped once the overlay is off screen
+        self.inv_alpha = None
+        self.premultiplied = None
+        self._scratch = None
+
+    def blend_into(self, frame: np.ndarray):
+        frame_height, frame_width = frame.shape[:2]
+        x0, y0 = max(self.x, 0), max(self.y, 0)
+        x1, y1 = min(self.x + self.width, frame_width), min(self.y + self.height, frame_height)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        self.prepare()
+        ox0, oy0 = x0 - self.x, y0 - self.y
+        ox1, oy1 = ox0 + (x1 - x0), oy0 + (y1 - y0)
+        roi = frame[y0:y1, x0:x1, :3]
+        blended = self._scratch[oy0:oy1, ox0:ox1]
+        np.multiply(roi, self.inv_alpha[oy0:oy1, ox0:ox1], out=blended)
+        np.add(blended, self.premultiplied[oy0:oy1, ox0:ox1], out=blended)
+        np.copyto(roi, blended, casting="unsafe")
+
+
+class OverlayTrack:
+    """
+    Overlays indexed by start time, so each frame only looks at the overlays active at its time,
+    whatever the number of overlays on the track.
+    """
+
+    def __init__(self):
+        self._overlays: List[Overlay] = []
+        self._starts = []
+        self._max_ends = []
+        self._indexed = True
+        self._prepared: List[Overlay] = []
+
+    def add(self, rgba: np.ndarray, x: int, y: int, start: float, end: float):
+        self._overlays.append(Overlay(rgba, x, y, start, end))
+        self._indexed = False
+
+    def _build_index(self):
+        self._overlays.sort(key=lambda o: o.start)
+        self._starts = [o.start for o in self._overlays]
+        # running maximum of the end times, to stop scanning backwards as soon as nothing can be active
+        self._max_ends = []
+        max_end = float("-inf")
+        for o in self._overlays:
+            max_end = max(max_end, o.end)
+            self._max_ends.append(max_end)
+        self._indexed = True
+
+    def __len__(self):
+        return len(self._overlays)
+
+    def active(self, t: float) -> List[Overlay]:
+        if not self._indexed:
+            self._build_index()
+        i = bisect.bisect_right(self._starts, t) - 1
+        overlays = []
+        while i >= 0 and self._max_ends[i] > t:
+            if self._overlays[i].end > t:
+                overlays.append(self._overlays[i])
+            i -= 1
+        overlays.reverse()
+        return overlays
+
+    def composite(self, frame: np.ndarray, t: float) -> np.ndarray:
+        overlays = self.active(t)
+        # only the overlays on screen keep their blending terms
+        for o in self._prepared:
+            if o not in overlays:
+                o.release()
+        self._prepared = overlays
+        if not overlays:
+            return frame
+        if not frame.flags.writeable:
+            frame = frame.copy()
+        for o in overlays:
+            o.blend_into(frame)
+        return frame
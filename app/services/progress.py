@@ -0,0 +1,127 @@
+import threading
+import time
+
+from loguru import logger
+from proglog import ProgressBarLogger
+
+from app.config import config
+from app.models import const
+from app.services import state as sm
+
+
+class RenderProgress:
+    """
+    Frame level progress of the renders of a task, written into the task state at most once per
+    `progress_interval` seconds: the task progress between `start` and `end`, the encoded frames,
+    the throughput (fps) and the ETA. One per task, every render (variant, aspect) registers the frames it
+    will encode with `expect()` up front and reports through its own `render()` reporter.
+    """
+
+    def __init__(self, task_id: str, start: int = 50, end: int = 99):
+        self.task_id = task_id
+        self.start = start
+        self.end = end
+        self.interval = config.app.get("progress_interval", 1.0)
+        self._expected = {}  # render => frames to encode
+        self._frames = {}  # render => {key: frames}, several encoders of a render (chunks, segments) use own keys
+        self._lock = threading.Lock()
+        self._started_at = time.time()
+        self._reported_at = 0.
+        # other fields kept in the task state while rendering, e.g. the playlist url
+        self.extra = {}
+
+    def set_extra(self, **fields):
+        # fields kept in the task state by every update, None removes one
+        with self._lock:
+            for name, value in fields.items():
+                if value is None:
+                    self.extra.pop(name, None)
+                else:
+                    self.extra[name] = value
+        self.flush()
+
+    def expect(self, render: str, frames: int):
+        # also when a render starts over, e.g. on the fallback to another backend
+        with self._lock:
+            self._expected[render] = max(int(frames), 1)
+            self._frames.pop(render, None)
+
+    def render(self, *renders: str) -> "RenderReporter":
+        # several renders when one encode writes several outputs, e.g. the aspects rendered together
+        return RenderReporter(self, renders)
+
+    def update(self, render: str, frame: int, key: str = ""):
+        with self._lock:
+            self._frames.setdefault(render, {})[key] = frame
+            now = time.time()
+            if now - self._reported_at < self.interval:
+                return
+            self._reported_at = now
+        self.flush()
+
+    def finish(self, render: str):
+        # the last update of a render may have been throttled, count all its frames
+        with self._lock:
+            self._frames[render] = {"": self._expected.get(render, 0)}
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            total_frames = max(sum(self._expected.values()), 1)
+            frames = sum(min(sum(self._frames.get(render, {}).values()), expected)
+                         for render, expected in self._expected.items())
+            extra = dict(self.extra)
+        now = time.time()
+        elapsed = max(now - self._started_at, 1e-6)
+        render_fps = frames / elapsed
+        eta = (total_frames - frames) / render_fps if render_fps > 0 else -1
+        progress = self.start + (self.end - self.start) * frames / total_frames
+        sm.state.update_task(self.task_id,
+                             state=const.TASK_STATE_PROCESSING,
+                             progress=progress,
+                             render_frames=frames,
+                             render_total_frames=total_frames,
+                             render_fps=round(render_fps, 1),
+                             render_eta=round(eta, 1),
+                             **extra,
+                             )
+        logger.debug(f"render progress: {frames}/{total_frames} frames, {render_fps:.1f} fps, eta {eta:.0f}s")
+
+
+class RenderReporter:
+    """
+    The progress of one render of the task, what the render backends report to.
+    """
+
+    def __init__(self, progress: RenderProgress, renders: tuple):
+        self.progress = progress
+        self.renders = renders
+
+    def update(self, frame: int, key: str = ""):
+        for render in self.renders:
+            self.progress.update(render, frame, key)
+
+    def finish(self):
+        for render in self.renders:
+            self.progress.finish(render)
+
+
+class MoviepyLogger(ProgressBarLogger):
+    """
+    proglog logger of write_videofile, forwards the frame index of the video encode.
+    """
+
+    def __init__(self, reporter: RenderReporter, key: str = ""):
+        super().__init__()
+        self.reporter = reporter
+        self.key = key
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        # "t" is the bar of the video frames, "chunk" the one of the audio
+        if bar == "t" and attr == "index":
+            self.reporter.update(value, self.key)
+
+
+def moviepy_logger(reporter: RenderReporter = None, key: str = ""):
+    # keyword argument `logger` of write_videofile, `key` tells apart the encodes of the same render
+    return MoviepyLogger(reporter, key) if reporter else None
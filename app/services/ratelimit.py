@@ -0,0 +1,134 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from app.config import config
+from app.services import shared
+
+
+class TokenBucket:
+    """
+    Token bucket shared by the processes of the node, `rate` tokens are added per second, 0 means unlimited.
+    Requests larger than the bucket are allowed and paid back by waiting, so callers are served in order.
+    """
+
+    def __init__(self, key: str, rate: float, capacity: float = 0):
+        self.key = key
+        self.rate = float(rate or 0)
+        self.capacity = float(capacity or max(self.rate, 1))
+
+    def acquire(self, amount: float = 1):
+        if self.rate <= 0:
+            return
+
+        with shared.get_store().transaction(self.key) as bucket:
+            now = time.time()
+            tokens = bucket.get("tokens", self.capacity)
+            last = bucket.get("last", now)
+            tokens = min(self.capacity, tokens + max(now - last, 0) * self.rate) - amount
+            bucket["tokens"] = tokens
+            bucket["last"] = now
+        wait = -tokens / self.rate if tokens < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HostLimiter:
+    """
+    Limits requests per second, concurrent connections and bytes per second for one host on this node,
+    the limits are shared by the processes of the node through shared.get_store().
+    """
+
+    def __init__(self, host: str, requests_per_second: float = 0, max_connections: int = 0,
+                 bytes_per_second: float = 0, window: float = 5):
+        self.host = host
+        self._requests = TokenBucket(f"ratelimit:{host}:requests", requests_per_second)
+        self._bytes = TokenBucket(f"ratelimit:{host}:bytes", bytes_per_second)
+        self._connections = shared.Leases(f"ratelimit:{host}:connections", max_connections) \
+            if max_connections > 0 else None
+
+        self._lock = threading.Lock()
+        self._window = window
+        self._transfers = deque()
+        self._request_times = deque()
+        self._waiting = 0
+        self._active = 0
+
+    @contextmanager
+    def request(self):
+        with self._lock:
+            self._waiting += 1
+        lease = None
+        try:
+            if self._connections:
+                lease = self._connections.acquire()
+            self._requests.acquire(1)
+        except BaseException:
+            with self._lock:
+                self._waiting -= 1
+            if lease:
+                self._connections.release(lease)
+            raise
+
+        with self._lock:
+            self._waiting -= 1
+            self._active += 1
+            self._request_times.append(time.monotonic())
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._active -= 1
+            if lease:
+                self._connections.release(lease)
+
+    def consume(self, nbytes: int):
+        self._bytes.acquire(nbytes)
+        with self._lock:
+            self._transfers.append((time.monotonic(), nbytes))
+
+    def stats(self) -> dict:
+        with self._lock:
+            now = time.monotonic()
+            while self._transfers and now - self._transfers[0][0] > self._window:
+                self._transfers.popleft()
+            while self._request_times and now - self._request_times[0] > self._window:
+                self._request_times.popleft()
+            stats = {
+                "host": self.host,
+                "active": self._active,
+                "waiting": self._waiting,
+                "bytes_per_second": sum(n for _, n in self._transfers) / self._window,
+                "requests_per_second": len(self._request_times) / self._window,
+            }
+        if self._connections:
+            # the connections of all the processes of the node
+            stats["node_connections"] = self._connections.count()
+        return stats
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(url: str) -> HostLimiter:
+    host = urlparse(url).netloc or url
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = HostLimiter(host=host,
+                                  requests_per_second=config.pexels.get("max_requests_per_second", 0),
+                                  max_connections=config.pexels.get("max_connections", 0),
+                                  bytes_per_second=config.pexels.get("max_bytes_per_second", 0),
+                                  )
+            _limiters[host] = limiter
+        return limiter
+
+
+def stats() -> list:
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return [limiter.stats() for limiter in limiters]
@@ -0,0 +1,156 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from loguru import logger
+from moviepy.video.io.VideoFileClip import VideoFileClip
+
+from app.config import config
+
+
+class _Reader:
+    def __init__(self, clip: VideoFileClip):
+        self.clip = clip
+        self.owner = None  # the thread using the reader, a reader keeps a position and can't be shared
+        self.refs = 0
+        self.keep = True
+
+
+class ReaderPool:
+    """
+    Open VideoFileClip readers by file. Every reader holds an ffmpeg process and its pipe buffers, so they are
+    reused for the same file within a thread, kept idle up to `max_readers` and closed beyond that.
+    """
+
+    def __init__(self, max_readers: int = 0):
+        self.max_readers = max_readers or config.app.get("max_clip_readers", 16)
+        self._lock = threading.Lock()
+        self._readers = OrderedDict()  # (path, audio) => [_Reader], least recently used first
+        self._opened = 0
+        self._reused = 0
+
+    def _acquire(self, key: tuple, keep: bool) -> _Reader:
+        owner = threading.get_ident()
+        with self._lock:
+            for reader in self._readers.get(key, []):
+                if reader.owner in (None, owner):
+                    reader.owner = owner
+                    reader.refs += 1
+                    reader.keep = reader.keep and keep
+                    self._readers.move_to_end(key)
+                    self._reused += 1
+                    return reader
+
+        # opening a reader starts ffmpeg, don't hold the lock meanwhile
+        reader = _Reader(VideoFileClip(key[0], audio=key[1]))
+        reader.owner = owner
+        reader.refs = 1
+        reader.keep = keep
+        with self._lock:
+            self._readers.setdefault(key, []).append(reader)
+            self._readers.move_to_end(key)
+            self._opened += 1
+        return reader
+
+    def _release(self, reader: _Reader):
+        with self._lock:
+            reader.refs -= 1
+            if reader.refs > 0:
+                return
+            reader.owner = None
+            to_close = []
+            if not reader.keep:
+                self._remove(reader)
+                to_close.append(reader)
+            to_close += self._evict()
+        for r in to_close:
+            _close(r)
+
+    def _remove(self, reader: _Reader):
+        for key, readers in list(self._readers.items()):
+            if reader in readers:
+                readers.remove(reader)
+                if not readers:
+                    del self._readers[key]
+
+    def _evict(self) -> list:
+        # called with the lock held, returns the idle readers over the bound, least recently used first
+        to_close = []
+        count = sum(len(readers) for readers in self._readers.values())
+        for key in list(self._readers.keys()):
+            if count <= self.max_readers:
+                break
+            for reader in [r for r in self._readers[key] if r.refs == 0]:
+                self._readers[key].remove(reader)
+                to_close.append(reader)
+                count -= 1
+                if count <= self.max_readers:
+                    break
+            if not self._readers[key]:
+                del self._readers[key]
+        return to_close
+
+    @contextmanager
+    def open(self, file_path: str, audio: bool = False, keep: bool = True):
+        """
+        A reader of `file_path` for the duration of the with block, clips derived from it (subclip, resize...)
+        must not be used after the block. `keep=False` closes the reader at the end, for files read only once.
+        """
+        reader = self._acquire((file_path, audio), keep)
+        try:
+            yield reader.clip
+        finally:
+            self._release(reader)
+
+    def close_idle(self, directory: str = ""):
+        """
+        Close the idle readers, only those of the files under `directory` if given, e.g. before it is removed.
+        """
+        directory = os.path.join(os.path.abspath(directory), "") if directory else ""
+        with self._lock:
+            to_close = []
+            for key in list(self._readers.keys()):
+                if directory and not os.path.abspath(key[0]).startswith(directory):
+                    continue
+                idle = [r for r in self._readers[key] if r.refs == 0]
+                for reader in idle:
+                    self._readers[key].remove(reader)
+                to_close += idle
+                if not self._readers[key]:
+                    del self._readers[key]
+        for reader in to_close:
+            _close(reader)
+
+    def stats(self) -> dict:
+        with self._lock:
+            readers = [r for rs in self._readers.values() for r in rs]
+            return {
+                "open": len(readers),
+                "in_use": len([r for r in readers if r.refs > 0]),
+                "max_readers": self.max_readers,
+                "opened": self._opened,
+                "reused": self._reused,
+            }
+
+
+def _close(reader: _Reader):
+    try:
+        reader.clip.close()
+    except Exception as e:
+        logger.warning(f"failed to close video reader: {reader.clip.filename} => {str(e)}")
+
+
+pool = ReaderPool()
+
+
+def open_clip(file_path: str, audio: bool = False, keep: bool = True):
+    return pool.open(file_path, audio=audio, keep=keep)
+
+
+def close_idle(directory: str = ""):
+    pool.close_idle(directory)
+
+
+def stats() -> dict:
+    return pool.stats()
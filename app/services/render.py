@@ -0,0 +1,391 @@
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from loguru import logger
+
+from app.config import config
+from app.models.edl import Edl, EdlClip
+from app.services import audio, encoder, mezzanine, subtitle
+from app.services.progress import RenderReporter
+from app.utils import utils, ffmpeg
+
+
+def get_profile(edl: Edl) -> dict:
+    return encoder.get_profile(edl.encoder_profile, edl.quality)
+
+
+def create_ass(edl: Edl) -> str:
+    if not edl.subtitle_path or not os.path.exists(edl.subtitle_path):
+        return ""
+    ass_file = f"{os.path.splitext(edl.subtitle_path)[0]}-{edl.width}x{edl.height}.ass"
+    # shared by the variants of a task that are rendered at the same time
+    with utils.single_flight(ass_file):
+        return subtitle.create_ass(edl.subtitle_path, ass_file, edl.subtitle_style, edl.width, edl.height)
+
+
+def _on_progress(reporter: RenderReporter = None, key: str = ""):
+    # on_progress callback of ffmpeg.run
+    if reporter is None:
+        return None
+    return lambda frame: reporter.update(frame, key)
+
+
+def progressive_mode() -> str:
+    # "hls": HLS playlist of fMP4 segments, "fmp4": fragmented final.mp4, "": regular mp4 at the end
+    return config.app.get("progressive_output", "").strip().lower()
+
+
+def writes_progressive(render_backend: str, outputs: int = 1) -> bool:
+    """
+    Whether the backend writes the progressive output: only the single output encodes of "ffmpeg" and "frames",
+    the chunked, incremental, multi-output and moviepy renders write a regular mp4 at the end.
+    """
+    if not progressive_mode():
+        return False
+    return render_backend == "frames" or (render_backend == "ffmpeg" and outputs == 1)
+
+
+def progressive_file(output_file: str) -> str:
+    """
+    The file that can be played while `output_file` is being rendered, empty if there is none.
+    """
+    mode = progressive_mode()
+    if mode == "hls":
+        return os.path.join(_work_dir(output_file, "hls"), "playlist.m3u8")
+    if mode == "fmp4":
+        return output_file
+    return ""
+
+
+def output_url(file_path: str) -> str:
+    """
+    URL of a file of the storage directory behind the configured `endpoint`, or the path of the file.
+    """
+    endpoint = config.app.get("endpoint", "").strip().rstrip("/")
+    if not endpoint:
+        return file_path
+    rel_path = os.path.relpath(file_path, utils.storage_dir()).replace("\\", "/")
+    return f"{endpoint}/{rel_path}"
+
+
+def output_args(output_file: str, progressive: bool = True) -> list:
+    """
+    Muxer arguments of the encode, progressive outputs are readable while they are written.
+    """
+    mode = progressive_mode() if progressive else ""
+    if mode == "hls":
+        hls_dir = _work_dir(output_file, "hls")
+        os.makedirs(hls_dir, exist_ok=True)
+        # a keyframe every 2 seconds, so every segment can be played on its own
+        return ["-force_key_frames", "expr:gte(t,n_forced*2)",
+                "-f", "hls", "-hls_time", "2", "-hls_playlist_type", "event",
+                "-hls_segment_type", "fmp4",
+                "-hls_segment_filename", os.path.join(hls_dir, "segment-%05d.m4s"),
+                progressive_file(output_file)]
+    if mode == "fmp4":
+        return ["-movflags", "+frag_keyframe+empty_moov+default_base_moof", output_file]
+    return ["-movflags", "+faststart", output_file]
+
+
+def finish_output(output_file: str, progressive: bool = True):
+    # the segments are remuxed into the regular output, no re-encoding
+    if progressive and progressive_mode() == "hls":
+        ffmpeg.run(["-i", progressive_file(output_file), "-c", "copy", "-movflags", "+faststart", output_file])
+
+
+def _work_dir(output_file: str, name: str) -> str:
+    # intermediates of one output, several outputs of a task may be rendered at the same time
+    return f"{os.path.splitext(output_file)[0]}-{name}"
+
+
+def _video_filters(edl: Edl, clips: List[EdlClip], ass_file: str = "", offset: float = 0):
+    """
+    Inputs and filters that turn `clips` into one video stream labeled [vout], with the subtitles of `ass_file`
+    burned in. `offset` is the position of the first clip on the output timeline, used to time the subtitles.
+    """
+    args = []
+    filters = []
+    video_labels = []
+    for i, clip in enumerate(clips):
+        args += ["-ss", f"{clip.start:.3f}", "-t", f"{clip.duration:.3f}", "-i", clip.source]
+        filters.append(f"[{i}:v]{normalize_filter(edl, source=clip.source)}[v{i}]")
+        video_labels.append(f"[v{i}]")
+    filters.append(f"{''.join(video_labels)}{_timeline_filter(edl, len(video_labels), ass_file, offset)}[vout]")
+    return args, filters
+
+
+def normalize_filter(edl: Edl, pix_fmt: str = "yuv420p", source: str = "") -> str:
+    """
+    Scale and letterbox a clip to the output format. With the `source`, only the conversions it needs are done,
+    e.g. a 30 fps clip of the output size passes through.
+    """
+    convert = {"scale": True, "fps": True, "pix_fmt": True}
+    if source:
+        convert = ffmpeg.negotiate(source, edl.width, edl.height, edl.fps, pix_fmt)
+
+    filters = []
+    if convert["scale"]:
+        filters += [f"scale={edl.width}:{edl.height}:force_original_aspect_ratio=decrease",
+                    f"pad={edl.width}:{edl.height}:(ow-iw)/2:(oh-ih)/2:color=black"]
+    # metadata only, concat needs the same sample aspect ratio on every input
+    filters.append("setsar=1")
+    if convert["fps"]:
+        filters.append(f"fps={edl.fps}")
+    if convert["pix_fmt"]:
+        filters.append(f"format={pix_fmt}")
+    return ",".join(filters)
+
+
+def _timeline_filter(edl: Edl, count: int, ass_file: str = "", offset: float = 0) -> str:
+    # concatenate `count` normalized clips and burn the subtitles in
+    video_filter = f"concat=n={count}:v=1:a=0"
+    if ass_file:
+        if offset:
+            video_filter += f",setpts=PTS+{offset:.3f}/TB"
+        video_filter += (f",subtitles=filename='{ffmpeg.escape_filter_value(ass_file)}'"
+                         f":fontsdir='{ffmpeg.escape_filter_value(utils.font_dir())}'")
+        if offset:
+            video_filter += ",setpts=PTS-STARTPTS"
+    return video_filter
+
+
+def render_video(edl: Edl, output_file: str, threads: int = 0, reporter: RenderReporter = None,
+                 progressive: bool = True) -> str:
+    """
+    Compile the EDL into one ffmpeg filtergraph and encode it once:
+    concat + scale/pad + fps of the clips and subtitle burn-in, the pre-mixed audio track is muxed as is.
+    """
+    args, filters = _video_filters(edl, edl.clips, ass_file=create_ass(edl))
+    audio_file = audio.render(edl)
+    if audio_file:
+        args += ["-i", audio_file]
+
+    args += ["-filter_complex", ";".join(filters), "-map", "[vout]"]
+    if audio_file:
+        args += ["-map", f"{len(edl.clips)}:a", "-c:a", "copy"]
+    args += ["-t", f"{edl.duration:.3f}",
+             *encoder.ffmpeg_args(get_profile(edl), threads or encoder.get_threads()),
+             "-r", str(edl.fps),
+             *output_args(output_file, progressive)]
+
+    logger.info(f"rendering {len(edl.clips)} clips with ffmpeg, duration: {edl.duration:.2f}s => {output_file}")
+    ffmpeg.run(args, on_progress=_on_progress(reporter))
+    finish_output(output_file, progressive)
+    logger.success(f"completed")
+    return output_file
+
+
+def clip_frames(edl: Edl, clip: EdlClip) -> int:
+    # the clips of a planned timeline are whole frames long, see timeline.plan()
+    return max(round(clip.duration * edl.fps), 1)
+
+
+def split_chunks(edl: Edl, count: int) -> List[List[EdlClip]]:
+    """
+    Split the clips into at most `count` runs of consecutive clips with about the same number of frames,
+    chunks always start and end at clip boundaries.
+    """
+    count = max(1, min(count, len(edl.clips)))
+    target = sum(clip_frames(edl, clip) for clip in edl.clips) / count
+    chunks = [[]]
+    chunk_frames = 0
+    for clip in edl.clips:
+        if chunks[-1] and chunk_frames >= target and len(chunks) < count:
+            chunks.append([])
+            chunk_frames = 0
+        chunks[-1].append(clip)
+        chunk_frames += clip_frames(edl, clip)
+    return chunks
+
+
+def _render_chunk(edl: Edl, clips: List[EdlClip], ass_file: str, chunk_file: str, threads: int,
+                  reporter: RenderReporter = None) -> str:
+    offset = clips[0].slot
+    frames = sum(clip_frames(edl, clip) for clip in clips)
+    args, filters = _video_filters(edl, clips, ass_file=ass_file, offset=offset)
+    # closed GOPs, so the chunks can be joined without re-encoding,
+    # and an exact frame count, so the joined chunks keep in sync with the audio
+    ffmpeg.run([*args, "-filter_complex", ";".join(filters), "-map", "[vout]", "-an",
+                "-frames:v", str(frames),
+                *encoder.ffmpeg_args(get_profile(edl), threads),
+                "-r", str(edl.fps), "-flags", "+cgop",
+                chunk_file],
+               on_progress=_on_progress(reporter, key=f"{offset:.3f}"))
+    return chunk_file
+
+
+def _join_chunks(edl: Edl, chunk_files: List[str], work_dir: str, output_file: str):
+    """
+    Join encoded chunks with the concat demuxer (no re-encoding) and mux the audio once.
+    """
+    audio_file = audio.render(edl)
+
+    list_file = os.path.join(work_dir, "chunks.txt")
+    with open(list_file, "w", encoding="utf-8") as f:
+        for chunk_file in chunk_files:
+            f.write(f"file '{os.path.abspath(chunk_file)}'\n")
+
+    args = ["-f", "concat", "-safe", "0", "-i", list_file]
+    if audio_file:
+        args += ["-i", audio_file, "-map", "0:v", "-map", "1:a"]
+    args += ["-c", "copy", "-t", f"{edl.duration:.3f}", "-movflags", "+faststart", output_file]
+    ffmpeg.run(args)
+
+
+def render_video_chunked(edl: Edl, output_file: str, workers: int = 0, reporter: RenderReporter = None) -> str:
+    """
+    Encode the timeline in chunks split at clip boundaries, in parallel ffmpeg processes,
+    then join them with the concat demuxer (stream copy) and mux the audio once.
+    """
+    cpu_count = encoder.get_cpu_count()
+    if not workers:
+        # libx264 scales poorly past a few threads per encode
+        workers = max(1, cpu_count // 4)
+    chunks = split_chunks(edl, workers)
+    threads = encoder.get_threads(encoders=len(chunks))
+
+    chunk_dir = _work_dir(output_file, "chunks")
+    os.makedirs(chunk_dir, exist_ok=True)
+    logger.info(f"rendering {len(edl.clips)} clips in {len(chunks)} chunks, {threads} threads each => {output_file}")
+
+    try:
+        ass_file = create_ass(edl)
+        with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+            futures = [pool.submit(_render_chunk, edl, clips, ass_file,
+                                   os.path.join(chunk_dir, f"chunk-{i:03d}.mp4"), threads, reporter)
+                       for i, clips in enumerate(chunks)]
+            chunk_files = [future.result() for future in futures]
+
+        _join_chunks(edl, chunk_files, chunk_dir, output_file)
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+    logger.success(f"completed")
+    return output_file
+
+
+def segment_cache_dir() -> str:
+    return utils.cache_dir("segment_cache_directory", "cache_segments")
+
+
+def segment_hash(edl: Edl, clip: EdlClip) -> str:
+    """
+    Hash of everything that changes the pixels of one clip on the output: source, in/out points, output format,
+    encoder profile, and the subtitles shown during the clip (relative to its slot) with their style.
+    """
+    clip_end = clip.slot + clip.duration
+    overlays = [(round(max(o.start, clip.slot) - clip.slot, 3), round(min(o.end, clip_end) - clip.slot, 3), o.text)
+                for o in edl.overlays if o.start < clip_end and o.end > clip.slot]
+    key = {
+        "source": mezzanine.source_hash(clip.source),
+        "start": round(clip.start, 3),
+        "end": round(clip.end, 3),
+        "format": [edl.width, edl.height, edl.fps],
+        "profile": get_profile(edl),
+        "overlays": overlays,
+        "style": edl.subtitle_style.model_dump() if overlays else None,
+    }
+    return utils.md5(json.dumps(key, sort_keys=True, ensure_ascii=False))
+
+
+def _render_segment(edl: Edl, clip: EdlClip, ass_file: str, threads: int, reporter: RenderReporter = None) -> str:
+    key = segment_hash(edl, clip)
+    segment_file = os.path.join(segment_cache_dir(), f"seg-{key}.mp4")
+    if os.path.exists(segment_file) and os.path.getsize(segment_file) > 0:
+        if reporter:
+            reporter.update(clip_frames(edl, clip), key=f"{clip.slot:.3f}")
+        return segment_file
+
+    with utils.single_flight(key, lock_file=f"{segment_file}.lock"):
+        if os.path.exists(segment_file) and os.path.getsize(segment_file) > 0:
+            return segment_file
+        temp_file = segment_file.replace(".mp4", ".part.mp4")
+        try:
+            _render_chunk(edl, [clip], ass_file, temp_file, threads, reporter)
+            os.replace(temp_file, segment_file)
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+    return segment_file
+
+
+def render_video_incremental(edl: Edl, output_file: str, workers: int = 0, reporter: RenderReporter = None) -> str:
+    """
+    Encode every clip as a segment cached by the hash of its inputs and stitch the segments together,
+    so a re-render only encodes the segments that changed.
+    """
+    cpu_count = encoder.get_cpu_count()
+    if not workers:
+        workers = max(1, cpu_count // 4)
+
+    keys = [segment_hash(edl, clip) for clip in edl.clips]
+    cache_dir = segment_cache_dir()
+    missing = [clip for clip, key in zip(edl.clips, keys)
+               if not os.path.exists(os.path.join(cache_dir, f"seg-{key}.mp4"))]
+    threads = encoder.get_threads(encoders=max(1, min(workers, len(missing))))
+    logger.info(f"rendering {len(missing)} of {len(edl.clips)} segments, "
+                f"{len(edl.clips) - len(missing)} reused from the cache => {output_file}")
+
+    work_dir = _work_dir(output_file, "segments")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        # a cached segment may be gone by the time it is rendered, it must get the subtitles too
+        ass_file = create_ass(edl)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_render_segment, edl, clip, ass_file, threads, reporter) for clip in edl.clips]
+            segment_files = [future.result() for future in futures]
+        _join_chunks(edl, segment_files, work_dir, output_file)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    logger.success(f"completed")
+    return output_file
+
+
+def render_video_multi(edls: List[Edl], output_files: List[str], threads: int = 0,
+                       reporter: RenderReporter = None) -> List[str]:
+    """
+    Render the same timeline in several output formats (e.g. 9:16, 16:9 and 1:1) with one ffmpeg process:
+    every source is decoded once and split into a scale/pad branch per output, each with its own subtitle layout
+    and encoder. The audio is mixed once and shared by all the outputs.
+    """
+    base = edls[0]
+    count = len(edls)
+
+    args = []
+    filters = []
+    for i, clip in enumerate(base.clips):
+        args += ["-ss", f"{clip.start:.3f}", "-t", f"{clip.duration:.3f}", "-i", clip.source]
+        filters.append(f"[{i}:v]split={count}{''.join(f'[s{i}_{k}]' for k in range(count))}")
+
+    for k, edl in enumerate(edls):
+        video_labels = []
+        for i in range(len(base.clips)):
+            filters.append(f"[s{i}_{k}]{normalize_filter(edl, source=base.clips[i].source)}[v{i}_{k}]")
+            video_labels.append(f"[v{i}_{k}]")
+        filters.append(f"{''.join(video_labels)}{_timeline_filter(edl, len(video_labels), create_ass(edl))}[vout{k}]")
+
+    audio_file = audio.render(base)
+    if audio_file:
+        args += ["-i", audio_file]
+
+    args += ["-filter_complex", ";".join(filters)]
+    threads = threads or encoder.get_threads(encoders=count)
+    for k, (edl, output_file) in enumerate(zip(edls, output_files)):
+        args += ["-map", f"[vout{k}]"]
+        if audio_file:
+            args += ["-map", f"{len(base.clips)}:a", "-c:a", "copy"]
+        args += ["-t", f"{edl.duration:.3f}",
+                 *encoder.ffmpeg_args(get_profile(edl), threads),
+                 "-r", str(edl.fps),
+                 "-movflags", "+faststart",
+                 output_file]
+
+    logger.info(f"rendering {len(base.clips)} clips to {count} outputs with ffmpeg: {output_files}")
+    ffmpeg.run(args, on_progress=_on_progress(reporter))
+
+    logger.success(f"completed")
+    return output_files
@@ -0,0 +1,75 @@
+import os
+import shutil
+import time
+
+from loguru import logger
+
+from app.config import config
+from app.utils import utils
+
+
+def root() -> str:
+    # e.g. a tmpfs or a local NVMe, empty: the transient files stay in the task directory
+    return config.app.get("scratch_directory", "").strip()
+
+
+def enabled() -> bool:
+    return bool(root())
+
+
+def _tasks_root() -> str:
+    # a sub directory of its own, the scratch root may be shared, e.g. /dev/shm
+    return os.path.join(root(), "tasks")
+
+
+def task_dir(task_id: str) -> str:
+    """
+    Directory of the transient files of a task: audio, subtitles, combined videos and encodes in progress.
+    """
+    if not enabled():
+        return utils.task_dir(task_id)
+    d = os.path.join(_tasks_root(), task_id)
+    if not os.path.exists(d):
+        os.makedirs(d, exist_ok=True)
+    return d
+
+
+def promote(file_path: str, task_id: str) -> str:
+    """
+    Move a deliverable from the scratch space to the durable task directory, returns its new path.
+    """
+    if not enabled() or not os.path.exists(file_path):
+        return file_path
+    dest_path = os.path.join(utils.task_dir(task_id), os.path.basename(file_path))
+    if os.path.abspath(dest_path) == os.path.abspath(file_path):
+        return file_path
+    # copy under a temporary name first, the destination is usually on another file system
+    temp_path = f"{dest_path}.part"
+    shutil.move(file_path, temp_path)
+    os.replace(temp_path, dest_path)
+    logger.info(f"promoted: {file_path} => {dest_path}")
+    return dest_path
+
+
+def cleanup(task_id: str):
+    if not enabled():
+        return
+    shutil.rmtree(os.path.join(_tasks_root(), task_id), ignore_errors=True)
+
+
+def cleanup_stale(max_age: float = 0):
+    """
+    Remove the scratch directories left by tasks that didn't finish, e.g. when the process was killed.
+    """
+    if not enabled() or not os.path.isdir(_tasks_root()):
+        return
+    max_age = max_age or config.app.get("scratch_max_age", 24) * 3600
+    now = time.time()
+    for name in os.listdir(_tasks_root()):
+        d = os.path.join(_tasks_root(), name)
+        try:
+            if os.path.isdir(d) and now - os.path.getmtime(d) > max_age:
+                shutil.rmtree(d, ignore_errors=True)
+                logger.info(f"removed stale scratch directory: {d}")
+        except OSError:
+            pass
@@ -0,0 +1,139 @@
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+from filelock import FileLock
+
+from app.config import config
+from app.utils import utils
+
+
+class FileStore:
+    """
+    JSON documents shared by the processes of this node, one file per key, updated under a FileLock.
+    """
+
+    def __init__(self, directory: str = ""):
+        self.directory = directory or utils.storage_dir("shared")
+        os.makedirs(self.directory, exist_ok=True)
+
+    @contextmanager
+    def transaction(self, key: str):
+        # the document of `key`, written back when the block exits without an error
+        file_path = os.path.join(self.directory, f"{utils.md5(key)}.json")
+        with FileLock(f"{file_path}.lock"):
+            data = {}
+            if os.path.exists(file_path):
+                try:
+                    with open(file_path, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                except Exception:
+                    data = {}
+            yield data
+            temp_file = f"{file_path}.part"
+            with open(temp_file, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(temp_file, file_path)
+
+
+class RedisStore:
+    """
+    The same documents in redis, when `enable_redis` is set. The keys are per node, like the FileStore.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None):
+        import redis
+        self._redis = redis.StrictRedis(host=host, port=port, db=db, password=password)
+        self._prefix = f"shared:{socket.gethostname()}:"
+
+    @contextmanager
+    def transaction(self, key: str):
+        name = f"{self._prefix}{key}"
+        with self._redis.lock(f"{name}:lock", timeout=30):
+            value = self._redis.get(name)
+            data = json.loads(value) if value else {}
+            yield data
+            self._redis.set(name, json.dumps(data))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            if config.app.get("enable_redis", False):
+                _store = RedisStore(host=config.app.get("redis_host", "localhost"),
+                                    port=config.app.get("redis_port", 6379),
+                                    db=config.app.get("redis_db", 0),
+                                    password=config.app.get("redis_password", None))
+            else:
+                _store = FileStore()
+        return _store
+
+
+def _alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    if os.name == "nt":
+        # os.kill() terminates the process on Windows, the leases expire instead
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Leases:
+    """
+    Holders of a resource across the processes of the node, at most `limit` at a time (0: unlimited, only counted).
+    The leases of dead processes are dropped, and any lease after `ttl` seconds.
+    """
+
+    def __init__(self, key: str, limit: int = 0, ttl: float = 3600, poll: float = 0.2):
+        self.key = key
+        self.limit = limit
+        self.ttl = ttl
+        self.poll = poll
+
+    def _active(self, data: dict) -> dict:
+        now = time.time()
+        leases = {lease: (pid, since) for lease, (pid, since) in data.get("leases", {}).items()
+                  if now - since < self.ttl and _alive(pid)}
+        data["leases"] = leases
+        return leases
+
+    def acquire(self) -> str:
+        lease = uuid4().hex
+        while True:
+            with get_store().transaction(self.key) as data:
+                leases = self._active(data)
+                if self.limit <= 0 or len(leases) < self.limit:
+                    leases[lease] = (os.getpid(), time.time())
+                    return lease
+            time.sleep(self.poll)
+
+    def release(self, lease: str):
+        with get_store().transaction(self.key) as data:
+            self._active(data).pop(lease, None)
+
+    def count(self) -> int:
+        with get_store().transaction(self.key) as data:
+            return len(self._active(data))
+
+    @contextmanager
+    def hold(self):
+        lease = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(lease)
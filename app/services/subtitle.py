@@ -1,12 +1,15 @@
 import json
 import os.path
 import re
+import threading
 
 from faster_whisper import WhisperModel
 from timeit import default_timer as timer
 from loguru import logger
 
 from app.config import config
+from app.models.edl import EdlSubtitleStyle
+from app.services import textrender
 from app.utils import utils
 
 model_size = config.whisper.get("model_size", "large-v3")
@@ -137,6 +140,95 @@ def file_to_subtitles(filename):
     return times_texts
 
 
+def parse_time(time_str: str) -> float:
+    # "00:00:01,520" => 1.52
+    hms, _, ms = time_str.strip().partition(",")
+    hours, minutes, seconds = hms.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds) + int(ms or 0) / 1000
+
+
+def file_to_items(filename):
+    """
+    [(start, end, text), ...] with the times in seconds
+    """
+    items = []
+    for _, times, text in file_to_subtitles(filename):
+        start_time, _, end_time = times.partition("-->")
+        items.append((parse_time(start_time), parse_time(end_time), text))
+    return items
+
+
+def to_ass_color(color: str) -> str:
+    # "#RRGGBB" => "&HAABBGGRR"
+    color = (color or "#FFFFFF").lstrip("#")
+    if len(color) != 6:
+        color = "FFFFFF"
+    return f"&H00{color[4:6]}{color[2:4]}{color[0:2]}".upper()
+
+
+def to_ass_time(seconds: float) -> str:
+    centiseconds = int(round(seconds * 100))
+    hours, centiseconds = divmod(centiseconds, 360000)
+    minutes, centiseconds = divmod(centiseconds, 6000)
+    seconds, centiseconds = divmod(centiseconds, 100)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}.{centiseconds:02d}"
+
+
+def create_ass(subtitle_file: str, ass_file: str, style: EdlSubtitleStyle, video_width: int, video_height: int):
+    """
+    Convert the srt file into an ass file with the subtitle style of the task, laid out for
+    video_width x video_height (same font, size, colors, stroke, position and line breaks as the moviepy renderer),
+    so it can be burned in by libass inside the encode.
+    """
+    font_name = textrender.get_font(style.font_path, style.font_size).getname()[0]
+    if style.position == "top":
+        alignment, margin_v = 8, video_height * 0.1
+    elif style.position == "center":
+        alignment, margin_v = 5, 0
+    else:
+        alignment, margin_v = 2, video_height * 0.05
+
+    outline_color = to_ass_color(style.stroke_color)
+    border_style = 1
+    if style.background_color and style.background_color != "transparent":
+        # opaque box, libass draws it with the outline colour
+        border_style = 3
+        outline_color = to_ass_color(style.background_color)
+
+    lines = [
+        "[Script Info]",
+        "ScriptType: v4.00+",
+        f"PlayResX: {video_width}",
+        f"PlayResY: {video_height}",
+        "WrapStyle: 2",
+        "ScaledBorderAndShadow: yes",
+        "",
+        "[V4+ Styles]",
+        "Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, "
+        "Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, "
+        "Alignment, MarginL, MarginR, MarginV, Encoding",
+        f"Style: Default,{font_name},{style.font_size},{to_ass_color(style.fore_color)},&H000000FF,"
+        f"{outline_color},&H00000000,0,0,0,0,100,100,0,0,{border_style},{style.stroke_width},0,"
+        f"{alignment},{int(video_width * 0.05)},{int(video_width * 0.05)},{int(margin_v)},1",
+        "",
+        "[Events]",
+        "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text",
+    ]
+    for start, end, text in file_to_items(subtitle_file):
+        # break the lines like wrap_text does, libass does not break CJK text
+        text_lines, _ = textrender.layout(text.replace("\n", " "), max_width=video_width * 0.9,
+                                          font_path=style.font_path, font_size=style.font_size)
+        text = "\\N".join(line.replace("{", "\\{").replace("}", "\\}") for line in text_lines)
+        lines.append(f"Dialogue: 0,{to_ass_time(start)},{to_ass_time(end)},Default,,0,0,0,,{text}")
+
+    # replaced atomically, a render of another variant may be reading the file through ffmpeg
+    temp_file = f"{ass_file}.{threading.get_ident()}.part"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temp_file, ass_file)
+    return ass_file
+
+
 def correct(subtitle_file, video_script):
     subtitle_items = file_to_subtitles(subtitle_file)
     script_lines = utils.split_string_by_punctuations(video_script)
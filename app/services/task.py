@@ -1,20 +1,210 @@
+import copy
+import shutil
 import streamlit as st
 import os.path
 import re
 from os import path
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 from moviepy.video.tools.subtitles import SubtitlesClip
 
 from loguru import logger
 
 from app.config import config
 from app.models import const
-from app.models.schema import VideoParams, VideoConcatMode
-from app.services import llm, material, voice, video, subtitle
+from app.models.edl import Edl
+from app.models.schema import VideoParams, VideoConcatMode, VideoAspect
+from app.services import llm, material, voice, video, subtitle, render, timeline, encoder, readers, framepipe, scratch, \
+    textrender, ratelimit
 from app.services import state as sm
+from app.services.progress import RenderProgress
 from app.utils import utils
 
 
+def get_expected_frames(edl: Edl, render_backend: str) -> int:
+    # the moviepy backend encodes every frame twice, the combined video then the final one
+    frames = int(edl.duration * edl.fps)
+    if render_backend in ("ffmpeg", "ffmpeg_chunked", "ffmpeg_incremental", "frames"):
+        return frames
+    return frames * 2
+
+
+def render_video(task_id: str,
+                 edl: Edl,
+                 params: VideoParams,
+                 audio_file: str,
+                 audio_duration: float,
+                 final_video_path: str,
+                 progress: RenderProgress,
+                 progressive: bool = False,
+                 ) -> Tuple[str, str]:
+    """
+    Render the EDL with the configured backend. `progressive`: write the progressive output if the backend can.
+    Returns the path of the combined video of the moviepy backend, and the progressive file that was written.
+    """
+    n_threads = params.n_threads
+    combined_video_path = ""
+    playable_file = ""
+    render_name = path.splitext(path.basename(final_video_path))[0]
+    reporter = progress.render(render_name)
+    name = render_name.replace("final", "combined", 1)
+
+    render_backend = config.app.get("render_backend", "moviepy").strip().lower()
+    if render_backend in ("ffmpeg", "ffmpeg_chunked", "ffmpeg_incremental", "frames"):
+        logger.info(f"\n\n## rendering video with {render_backend}: => {final_video_path}")
+        progressive = progressive and render.writes_progressive(render_backend)
+        playable_file = render.progressive_file(final_video_path) if progressive else ""
+        # the main video can be played while it is rendered, the others are listed when the task completes
+        live = playable_file and render_name == "final"
+        if live:
+            progress.set_extra(playlist_url=render.output_url(playable_file))
+            logger.info(f"progressive output: {progress.extra['playlist_url']}")
+        try:
+            if render_backend == "frames":
+                framepipe.render_video(edl=edl, output_file=final_video_path, threads=n_threads, reporter=reporter,
+                                       progressive=progressive)
+            elif render_backend == "ffmpeg_chunked":
+                render.render_video_chunked(edl=edl,
+                                            output_file=final_video_path,
+                                            workers=config.app.get("render_workers", 0),
+                                            reporter=reporter,
+                                            )
+            elif render_backend == "ffmpeg_incremental":
+                render.render_video_incremental(edl=edl,
+                                                output_file=final_video_path,
+                                                workers=config.app.get("render_workers", 0),
+                                                reporter=reporter,
+                                                )
+            else:
+                render.render_video(edl=edl, output_file=final_video_path, threads=n_threads, reporter=reporter,
+                                    progressive=progressive)
+        except Exception as e:
+            logger.error(f"failed to render video with {render_backend}, fallback to moviepy: {str(e)}")
+            render_backend = "moviepy"
+            if playable_file and playable_file != final_video_path:
+                # the playlist of the failed render would never be completed
+                shutil.rmtree(path.dirname(playable_file), ignore_errors=True)
+            playable_file = ""
+            if live:
+                progress.set_extra(playlist_url=None)
+            # the frames of the failed render don't count, the moviepy backend starts over
+            progress.expect(render_name, get_expected_frames(edl, render_backend))
+
+    if render_backend not in ("ffmpeg", "ffmpeg_chunked", "ffmpeg_incremental", "frames"):
+        combined_video_path = path.join(scratch.task_dir(task_id), f"{name}.mp4")
+        logger.info(f"\n\n## combining video: => {combined_video_path}")
+        video.combine_videos(combined_video_path=combined_video_path,
+                                video_paths=timeline.to_material_clips(edl),
+                                audio_duration=audio_duration,
+                                 video_aspect=params.video_aspect,
+                                 threads=n_threads,
+                                 video_quality=params.video_quality,
+                                 encoder_profile=params.encoder_profile,
+                                 reporter=reporter)
+
+        logger.info(f"\n\n## generating video: => {final_video_path}")
+        # Put everything together
+        bgm_track = timeline.get_audio_track(edl, "bgm")
+        video.generate_video(video_path=combined_video_path,
+                                 audio_path=audio_file,
+                                 subtitle_path=edl.subtitle_path,
+                                 output_file=final_video_path,
+                                 params=params,
+                                 bgm_file=bgm_track.source if bgm_track else "",
+                                 reporter=reporter,
+                                 )
+
+    reporter.finish()
+    return combined_video_path, playable_file
+
+
+def get_video_aspects(params: VideoParams) -> List[VideoAspect]:
+    """
+    The main aspect of the task followed by the extra ones, without duplicates.
+    """
+    aspects = []
+    for aspect in [params.video_aspect, *(params.video_aspects or [])]:
+        aspect = VideoAspect(aspect)
+        if aspect not in aspects:
+            aspects.append(aspect)
+    return aspects
+
+
+def get_video_names(edls: List[Edl], name: str = "final") -> List[str]:
+    # one video per aspect, the first one is <name>.mp4, the others <name>-<width>x<height>.mp4
+    return [name if i == 0 else f"{name}-{edl.width}x{edl.height}" for i, edl in enumerate(edls)]
+
+
+def render_videos(task_id: str,
+                  edls: List[Edl],
+                  aspects: List[VideoAspect],
+                  params: VideoParams,
+                  audio_file: str,
+                  audio_duration: float,
+                  progress: RenderProgress,
+                  name: str = "final",
+                  ) -> Tuple[List[str], List[str], List[str]]:
+    """
+    Render one video per aspect, see get_video_names().
+    With the ffmpeg backends the sources are decoded once for all the aspects.
+    Returns the final videos, the combined videos of the moviepy backend and the progressive files written.
+    """
+    render_backend = config.app.get("render_backend", "moviepy").strip().lower()
+    # encoded on the scratch space and promoted when done, progressive outputs must be served while encoding
+    progressive = render.writes_progressive(render_backend, outputs=len(edls))
+    output_dir = utils.task_dir(task_id) if progressive else scratch.task_dir(task_id)
+    video_names = get_video_names(edls, name)
+    final_video_paths = [path.join(output_dir, f"{video_name}.mp4") for video_name in video_names]
+
+    if len(edls) > 1 and render_backend in ("ffmpeg", "ffmpeg_chunked", "ffmpeg_incremental"):
+        logger.info(f"\n\n## rendering {len(edls)} aspects with one decode pass: => {final_video_paths}")
+        try:
+            # one encode writes all the aspects, its frames count for each of them
+            reporter = progress.render(*video_names)
+            render.render_video_multi(edls=edls, output_files=final_video_paths, threads=params.n_threads,
+                                      reporter=reporter)
+            reporter.finish()
+            return final_video_paths, [], []
+        except Exception as e:
+            logger.error(f"failed to render the aspects together, render them one by one: {str(e)}")
+            for video_name, edl in zip(video_names, edls):
+                progress.expect(video_name, get_expected_frames(edl, render_backend))
+
+    combined_video_paths = []
+    playable_files = []
+    for edl, aspect, final_video_path in zip(edls, aspects, final_video_paths):
+        # VideoParams is a plain class, the moviepy backend reads the aspect from it
+        aspect_params = copy.copy(params)
+        aspect_params.video_aspect = aspect
+        combined_video_path, playable_file = render_video(task_id=task_id,
+                                                          edl=edl,
+                                                          params=aspect_params,
+                                                          audio_file=audio_file,
+                                                          audio_duration=audio_duration,
+                                                          final_video_path=final_video_path,
+                                                          progress=progress,
+                                                          progressive=progressive,
+                                                          )
+        if combined_video_path:
+            combined_video_paths.append(combined_video_path)
+        if playable_file:
+            playable_files.append(playable_file)
+    return final_video_paths, combined_video_paths, playable_files
+
+
 def start(task_id, params: VideoParams):
+    # the transient files of the task are removed whatever happens, only the promoted videos are kept
+    scratch.cleanup_stale()
+    try:
+        return _start(task_id, params)
+    finally:
+        textrender.clear_cache()
+        # the pooled readers of the materials hold them open, close them before the directory goes away
+        readers.close_idle(scratch.task_dir(task_id))
+        scratch.cleanup(task_id)
+
+
+def _start(task_id, params: VideoParams):
     """
     {
         "video_subject": "",
@@ -34,7 +224,6 @@ def start(task_id, params: VideoParams):
     video_subject = params.video_subject
     voice_name = voice.parse_voice_name(params.voice_name)
     paragraph_number = params.paragraph_number
-    n_threads = params.n_threads
 
     video_script = params.video_script.strip()
     if not video_script:
@@ -46,7 +235,7 @@ def start(task_id, params: VideoParams):
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=10)
 
     logger.info("\n\n## generating audio")
-    audio_file = path.join(utils.task_dir(task_id), f"audio.mp3")
+    audio_file = path.join(scratch.task_dir(task_id), f"audio.mp3")
     sub_maker = voice.tts(text=video_script, voice_name=voice_name, voice_file=audio_file)
     if sub_maker is None:
         sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
@@ -61,7 +250,7 @@ def start(task_id, params: VideoParams):
 
     subtitle_path = ""
     if params.subtitle_enabled:
-        subtitle_path = path.join(utils.task_dir(task_id), f"subtitle.srt")
+        subtitle_path = path.join(scratch.task_dir(task_id), f"subtitle.srt")
         subtitle_provider = config.app.get("subtitle_provider", "").strip().lower()
 
         logger.info(f"\n\n## generating subtitle, provider: {subtitle_provider}")
@@ -86,43 +275,58 @@ def start(task_id, params: VideoParams):
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=40)
     
     video_terms = params.video_terms.strip()
-        
-    if not video_terms:
-        logger.info("\n\n## generating video terms")
-        sub = SubtitlesClip(subtitles=subtitle_path, encoding='utf-8')
-        video_terms = []
-        for subtitle_item in sub.subtitles:
-            phrase = subtitle_item[1]
-            response_prompt = llm.generate_prompt(subject=params.video_subject, script=phrase)
-            duration = subtitle_item[0][1] - subtitle_item[0][0]
-            video_terms.append((response_prompt, duration))
-            logger.debug(f"debug : {phrase, response_prompt, type(duration)}")
-            logger.debug(f"debug : {type(video_terms)}")
-    else:
-        logger.info("\n\n## reuse video terms")
-        sub = SubtitlesClip(subtitles=subtitle_path, encoding='utf-8')
-        logger.info(f"debug audio duration: {video_terms}")
-        tmp_idx = 0
-        tmp_terms = video_terms[1:-1].split(',')
-        video_terms = []
-        for subtitle_item in sub.subtitles:
-            response_prompt = tmp_terms[tmp_idx]
-            duration = subtitle_item[0][1] - subtitle_item[0][0]
-            video_terms.append((response_prompt, duration))
-            logger.debug(f"debug : {response_prompt, type(duration)}")
-            logger.debug(f"debug : {type(video_terms)}")
-            tmp_idx += 1
-        logger.info("\n\n## reuse video terms")
-        
+    # search and download the materials of each segment while the next prompts are being generated
+    prefetcher = material.Prefetcher(task_id)
+    # the pools of the prefetcher are shut down whatever happens, e.g. a failed LLM call
+    try:
+        if not video_terms:
+            logger.info("\n\n## generating video terms")
+            sub = SubtitlesClip(subtitles=subtitle_path, encoding='utf-8')
+            video_terms = []
+            for subtitle_item in sub.subtitles:
+                phrase = subtitle_item[1]
+                response_prompt = llm.generate_prompt(subject=params.video_subject, script=phrase)
+                duration = subtitle_item[0][1] - subtitle_item[0][0]
+                video_terms.append((response_prompt, duration))
+                prefetcher.submit(response_prompt, duration)
+                logger.debug(f"debug : {phrase, response_prompt, type(duration)}")
+                logger.debug(f"debug : {type(video_terms)}")
+        else:
+            logger.info("\n\n## reuse video terms")
+            sub = SubtitlesClip(subtitles=subtitle_path, encoding='utf-8')
+            logger.info(f"debug audio duration: {video_terms}")
+            tmp_idx = 0
+            tmp_terms = video_terms[1:-1].split(',')
+            video_terms = []
+            for subtitle_item in sub.subtitles:
+                response_prompt = tmp_terms[tmp_idx]
+                duration = subtitle_item[0][1] - subtitle_item[0][0]
+                video_terms.append((response_prompt, duration))
+                prefetcher.submit(response_prompt, duration)
+                logger.debug(f"debug : {response_prompt, type(duration)}")
+                logger.debug(f"debug : {type(video_terms)}")
+                tmp_idx += 1
+            logger.info("\n\n## reuse video terms")
 
-    sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=20)
-    
-    logger.info("\n\n## downloading videos")
-    downloaded_videos = material.download_videos(task_id=task_id,
-                                                 search_terms=video_terms,
-                                                 video_aspect=params.video_aspect,
-                                                 )
-    if not downloaded_videos:
+        sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=20)
+
+        video_count = max(params.video_count or 1, 1)
+
+        logger.info("\n\n## downloading videos")
+        # the variants share the search results, and the downloads of the clips they have in common
+        variant_videos = []
+        search_results = prefetcher.search_results()
+        for variant in range(video_count):
+            variant_videos.append(material.download_videos(task_id=task_id,
+                                                           search_terms=video_terms,
+                                                           video_aspect=params.video_aspect,
+                                                           search_results=search_results,
+                                                           variant=variant,
+                                                           ))
+    finally:
+        prefetcher.shutdown()
+    logger.info(f"download limits: {ratelimit.stats()}")
+    if not variant_videos[0]:
         sm.state.update_task(task_id, state=const.TASK_STATE_FAILED)
         logger.error(
             "failed to download videos, maybe the network is not available. if you are in China, please use a VPN.")
@@ -130,44 +334,81 @@ def start(task_id, params: VideoParams):
 
     sm.state.update_task(task_id, state=const.TASK_STATE_PROCESSING, progress=50)
 
-    final_video_paths = []
-    combined_video_paths = []
+    logger.info(f"\n\n## planning {video_count} videos")
+    aspects = get_video_aspects(params)
+    bgm_files = video.get_bgm_files(bgm_type=params.bgm_type, bgm_file=params.bgm_file, count=video_count)
+    variants = []
+    for variant, downloaded_videos in enumerate(variant_videos):
+        if not downloaded_videos:
+            logger.warning(f"no videos for variant {variant + 1}, skipped")
+            continue
+        # all the aspects share the same bgm
+        edls = []
+        for aspect in aspects:
+            edls.append(timeline.plan(video_clips=downloaded_videos,
+                                      audio_path=audio_file,
+                                      subtitle_path=subtitle_path,
+                                      params=params,
+                                      video_aspect=aspect,
+                                      bgm_file=bgm_files[variant],
+                                      ))
+        name = "final" if variant == 0 else f"final-{variant + 1}"
+        timeline.save(edls[0], path.join(scratch.task_dir(task_id), name.replace("final", "edl", 1) + ".json"))
+        for edl in edls:
+            logger.info(f"render plan {name} {edl.width}x{edl.height}: {timeline.estimate(edl)}")
+        variants.append((name, edls))
 
-    _progress = 50
+    # one progress for all the renders of the task, every video counts with the frames it encodes
+    render_backend = config.app.get("render_backend", "moviepy").strip().lower()
+    progress = RenderProgress(task_id, start=50, end=99)
+    for name, edls in variants:
+        for video_name, edl in zip(get_video_names(edls, name), edls):
+            progress.expect(video_name, get_expected_frames(edl, render_backend))
 
-    combined_video_path = path.join(utils.task_dir(task_id), f"combined.mp4")
-    logger.info(f"\n\n## combining video: => {combined_video_path}")
-    video.combine_videos(combined_video_path=combined_video_path,
-                            video_paths=downloaded_videos,
-                            audio_duration=audio_duration,
-                             video_aspect=params.video_aspect,
-                             threads=n_threads)
+    def render_variant(name: str, edls: List[Edl]):
+        with encoder.render_slot():
+            if len(aspects) == 1:
+                # several aspects share the decode of the original sources instead
+                edls = [timeline.with_proxies(edl) for edl in edls]
+            return render_videos(task_id=task_id,
+                                 edls=edls,
+                                 aspects=aspects,
+                                 params=params,
+                                 audio_file=audio_file,
+                                 audio_duration=audio_duration,
+                                 progress=progress,
+                                 name=name,
+                                 )
 
-    _progress += 50 / 2
-    sm.state.update_task(task_id, progress=_progress)
-
-    final_video_path = path.join(utils.task_dir(task_id), f"final.mp4")
-
-    logger.info(f"\n\n## generating video: => {final_video_path}")
-    # Put everything together
-    video.generate_video(video_path=combined_video_path,
-                             audio_path=audio_file,
-                             subtitle_path=subtitle_path,
-                             output_file=final_video_path,
-                             params=params,
-                             )
+    # the renders of the variants run side by side and split the cores, see encoder.get_threads()
+    final_video_paths = []
+    combined_video_paths = []
+    playable_files = []
+    with ThreadPoolExecutor(max_workers=max(config.app.get("variant_workers", 2), 1)) as executor:
+        futures = [executor.submit(render_variant, name, edls) for name, edls in variants]
+        for future in futures:
+            variant_final_paths, variant_combined_paths, variant_playable_files = future.result()
+            final_video_paths += variant_final_paths
+            combined_video_paths += variant_combined_paths
+            playable_files += variant_playable_files
 
-    _progress += 50 / 2
-    sm.state.update_task(task_id, progress=_progress)
+    # only the final videos are deliverables, the combined videos go away with the scratch space
+    final_video_paths = [scratch.promote(p, task_id) for p in final_video_paths]
+    if scratch.enabled():
+        combined_video_paths = []
 
-    final_video_paths.append(final_video_path)
-    combined_video_paths.append(combined_video_path)
+    sm.state.update_task(task_id, progress=100, **progress.extra)
 
     logger.success(f"task {task_id} finished, generated {len(final_video_paths)} videos.")
+    logger.info(f"clip readers: {readers.stats()}")
 
     kwargs = {
         "videos": final_video_paths,
         "combined_videos": combined_video_paths
     }
-    sm.state.update_task(task_id, state=const.TASK_STATE_COMPLETE, progress=100, **kwargs)
+    # the hls playlists, or the fragmented mp4 videos themselves, of the renders that wrote them
+    playlist_urls = [render.output_url(p) for p in playable_files if os.path.exists(p)]
+    if playlist_urls:
+        kwargs["playlist_urls"] = playlist_urls
+    sm.state.update_task(task_id, state=const.TASK_STATE_COMPLETE, progress=100, **{**progress.extra, **kwargs})
     return kwargs
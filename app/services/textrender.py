@@ -0,0 +1,176 @@
+import functools
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+from app.config import config
+
+
+@functools.lru_cache(maxsize=32)
+def get_font(font_path: str, font_size: int) -> ImageFont.FreeTypeFont:
+    # loading a font (and its glyph cache) is expensive, share one instance per (path, size)
+    return ImageFont.truetype(font_path, font_size)
+
+
+class FontMetrics:
+    """
+    Per-character advance widths of a font, measured once and memoized.
+    """
+
+    def __init__(self, font: ImageFont.FreeTypeFont):
+        self.font = font
+        self._advances = {}
+
+    def advance(self, char: str) -> float:
+        width = self._advances.get(char)
+        if width is None:
+            width = self.font.getlength(char)
+            self._advances[char] = width
+        return width
+
+    def width(self, text: str) -> float:
+        return sum(self.advance(c) for c in text)
+
+    def height(self, text: str) -> int:
+        left, top, right, bottom = self.font.getbbox(text)
+        return bottom - top
+
+
+@functools.lru_cache(maxsize=32)
+def get_metrics(font_path: str, font_size: int) -> FontMetrics:
+    return FontMetrics(get_font(font_path, font_size))
+
+
+def layout(text: str, max_width: float, font_path: str, font_size: int):
+    """
+    Break text into lines no wider than max_width: by words, or by characters (CJK) when a single word
+    does not fit. Widths are summed incrementally from cached advances, so each character is measured once.
+
+    Returns the lines and the height of one line.
+    """
+    metrics = get_metrics(font_path, font_size)
+    text = text.strip()
+    line_height = metrics.height(text)
+    if metrics.width(text) <= max_width:
+        return [text], line_height
+
+    space_width = metrics.advance(" ")
+    lines = []
+    line, line_width = [], 0.
+    for word in text.split(" "):
+        if not word:
+            continue
+        word_width = metrics.width(word)
+        if word_width > max_width:
+            lines = []
+            break
+        if line and line_width + space_width + word_width > max_width:
+            lines.append(" ".join(line))
+            line, line_width = [], 0.
+        line_width += (space_width if line else 0) + word_width
+        line.append(word)
+    else:
+        lines.append(" ".join(line))
+        return lines, line_height
+
+    line, line_width = "", 0.
+    for char in text:
+        char_width = metrics.advance(char)
+        if line and line_width + char_width > max_width:
+            lines.append(line.strip())
+            line, line_width = "", 0.
+        line += char
+        line_width += char_width
+    if line.strip():
+        lines.append(line.strip())
+    return lines, line_height
+
+
+def to_rgba(color: str) -> tuple:
+    if not color or color == "transparent":
+        return 0, 0, 0, 0
+    rgb = ImageColor.getrgb(color)
+    return rgb if len(rgb) == 4 else (*rgb, 255)
+
+
+class TextCache:
+    """
+    Rendered lines by text and style, least recently used first, bounded by the bytes of the bitmaps:
+    a full width subtitle line is a few MB of RGBA.
+    """
+
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes or int(config.app.get("text_cache_mb", 64) * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key: tuple):
+        with self._lock:
+            rgba = self._items.get(key)
+            if rgba is not None:
+                self._items.move_to_end(key)
+            return rgba
+
+    def put(self, key: tuple, rgba: np.ndarray):
+        if rgba.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = rgba
+            self._bytes += rgba.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+
+_text_cache = TextCache()
+
+
+def clear_cache():
+    # the lines of a task are rarely rendered again by the next one
+    _text_cache.clear()
+
+
+def render_text(text: str,
+                font_path: str,
+                font_size: int,
+                fore_color: str = "#FFFFFF",
+                background_color: str = "transparent",
+                stroke_color: str = "#000000",
+                stroke_width: float = 0,
+                ) -> np.ndarray:
+    """
+    Rasterize (multi-line, centered) text with Pillow into a read-only RGBA array of shape (h, w, 4),
+    rendered lines are cached by text and style, see TextCache.
+    """
+    key = (text, font_path, font_size, fore_color, background_color, stroke_color, stroke_width)
+    rgba = _text_cache.get(key)
+    if rgba is not None:
+        return rgba
+
+    font = get_font(font_path, font_size)
+    stroke = int(round(stroke_width or 0))
+
+    measure = ImageDraw.Draw(Image.new("RGBA", (1, 1)))
+    left, top, right, bottom = measure.multiline_textbbox((0, 0), text, font=font, stroke_width=stroke,
+                                                          align="center")
+    width, height = max(right - left, 1), max(bottom - top, 1)
+
+    image = Image.new("RGBA", (width, height), to_rgba(background_color))
+    draw = ImageDraw.Draw(image)
+    draw.multiline_text((-left, -top), text, font=font, fill=to_rgba(fore_color), align="center",
+                        stroke_width=stroke, stroke_fill=to_rgba(stroke_color))
+
+    rgba = np.asarray(image)
+    rgba.setflags(write=False)
+    _text_cache.put(key, rgba)
+    return rgba
@@ -0,0 +1,132 @@
+import os
+from typing import List
+
+from loguru import logger
+
+from app.config import config
+from app.models.edl import Edl, EdlClip, EdlOverlay, EdlSubtitleStyle, EdlAudioTrack
+from app.models.schema import VideoAspect, VideoParams, VideoQuality, MaterialClip
+from app.services import bgm, encoder, mezzanine, subtitle, video
+from app.utils import ffmpeg
+
+
+def plan(video_clips: List[MaterialClip],
+         audio_path: str,
+         subtitle_path: str,
+         params: VideoParams,
+         video_aspect: VideoAspect = None,
+         bgm_file: str = None,
+         ) -> Edl:
+    """
+    Build the edit decision list of a task, only the metadata of the media is read.
+    `video_aspect` and `bgm_file` override the ones of params, e.g. to plan several outputs of the same task.
+    """
+    video_aspect = VideoAspect(video_aspect or params.video_aspect)
+    video_quality = VideoQuality(params.video_quality or VideoQuality.full.value)
+    video_width, video_height, fps = video.get_output_format(video_aspect, video_quality)
+    text_scale = video_height / video_aspect.to_resolution()[1]
+
+    edl = Edl(width=video_width, height=video_height, fps=fps, quality=video_quality.value,
+              encoder_profile=encoder.get_profile_name(params.encoder_profile, video_quality))
+
+    # in/out points and slots on frame boundaries, so segments encoded apart join without drifting from the audio
+    slot_frames = 0
+    for clip in video_clips:
+        end = clip.end or ffmpeg.probe(clip.path)["duration"]
+        start_frame = round(clip.start * fps)
+        frames = max(int((end - start_frame / fps) * fps + 1e-6), 1)
+        edl.clips.append(EdlClip(source=clip.path, start=start_frame / fps, end=(start_frame + frames) / fps,
+                                 slot=slot_frames / fps))
+        slot_frames += frames
+    edl.duration = slot_frames / fps
+
+    if subtitle_path and os.path.exists(subtitle_path):
+        edl.subtitle_path = subtitle_path
+        edl.subtitle_style = EdlSubtitleStyle(font_path=video.get_font_path(params),
+                                              font_size=max(int(params.font_size * text_scale), 1),
+                                              fore_color=params.text_fore_color,
+                                              background_color=params.text_background_color,
+                                              stroke_color=params.stroke_color,
+                                              stroke_width=params.stroke_width * text_scale,
+                                              position=params.subtitle_position,
+                                              )
+        for start, end, text in subtitle.file_to_items(subtitle_path):
+            edl.overlays.append(EdlOverlay(kind="subtitle", text=text, start=start, end=end))
+
+    edl.audio_tracks.append(EdlAudioTrack(kind="voice", source=audio_path, volume=params.voice_volume))
+    if bgm_file is None:
+        bgm_file = video.get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
+    if bgm_file:
+        try:
+            # the loudness normalized loop decodes much faster than the mp3
+            bgm_file = bgm.get_loop_file(bgm_file)
+        except Exception as e:
+            logger.warning(f"failed to get the bgm loop, use the song: {str(e)}")
+        edl.audio_tracks.append(EdlAudioTrack(kind="bgm", source=bgm_file, volume=params.bgm_volume,
+                                              loop=True, fade_out=3))
+    return edl
+
+
+def with_proxies(edl: Edl) -> Edl:
+    """
+    A preview EDL reading its clips from cached low resolution proxies, same timing as the sources.
+    The missing proxies are transcoded, so it is part of the render, not of the plan.
+    """
+    if edl.quality != VideoQuality.preview.value:
+        return edl
+    edl = edl.model_copy(deep=True)
+    for clip in edl.clips:
+        try:
+            clip.source = mezzanine.get_normalized_video(clip.source, edl.width, edl.height, edl.fps)
+        except Exception as e:
+            logger.warning(f"failed to create proxy video, using the source: {str(e)}")
+    return edl
+
+
+def estimate(edl: Edl) -> dict:
+    """
+    Dry run of a render: output duration, bytes of the sources to decode and the expected encode cost.
+    """
+    sources = set(clip.source for clip in edl.clips)
+    source_bytes = sum(os.path.getsize(s) for s in sources if os.path.exists(s))
+    frames = int(edl.duration * edl.fps)
+    megapixels = frames * edl.width * edl.height / 1e6
+    # throughput of the encoder on this node, in megapixels per second
+    encode_speed = config.app.get("encode_megapixels_per_second", 60)
+    return {
+        "duration": edl.duration,
+        "clips": len(edl.clips),
+        "overlays": len(edl.overlays),
+        "source_bytes": source_bytes,
+        "frames": frames,
+        "megapixels": megapixels,
+        "encode_seconds": megapixels / encode_speed if encode_speed else 0,
+    }
+
+
+def save(edl: Edl, edl_file: str):
+    with open(edl_file, "w", encoding="utf-8") as f:
+        f.write(edl.model_dump_json(indent=2))
+
+
+def load(edl_file: str) -> Edl:
+    with open(edl_file, "r", encoding="utf-8") as f:
+        return Edl.model_validate_json(f.read())
+
+
+def to_material_clips(edl: Edl) -> List[MaterialClip]:
+    clips = []
+    for edl_clip in edl.clips:
+        clip = MaterialClip()
+        clip.path = edl_clip.source
+        clip.start = edl_clip.start
+        clip.end = edl_clip.end
+        clips.append(clip)
+    return clips
+
+
+def get_audio_track(edl: Edl, kind: str):
+    for track in edl.audio_tracks:
+        if track.kind == kind:
+            return track
+    return None
@@ -1,13 +1,16 @@
-import glob
 import random
+from contextlib import ExitStack
 from typing import List
-from PIL import ImageFont
 from loguru import logger
 from moviepy.editor import *
 from moviepy.video.tools.subtitles import SubtitlesClip
 
-from app.models.schema import VideoAspect, VideoParams, VideoConcatMode
-from app.utils import utils
+from app.config import config
+from app.models.edl import EdlAudioTrack
+from app.models.schema import VideoAspect, VideoParams, VideoConcatMode, VideoQuality, MaterialClip
+from app.services import audio, bgm, encoder, mezzanine, overlay, readers, textrender
+from app.services.progress import RenderReporter, moviepy_logger
+from app.utils import utils, ffmpeg
 
 
 def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
@@ -18,136 +21,136 @@ def get_bgm_file(bgm_type: str = "random", bgm_file: str = ""):
         return bgm_file
 
     if bgm_type == "random":
-        suffix = "*.mp3"
-        song_dir = utils.song_dir()
-        files = glob.glob(os.path.join(song_dir, suffix))
-        return random.choice(files)
+        return random.choice(bgm.list_songs())
 
     return ""
 
 
+def get_bgm_files(bgm_type: str = "random", bgm_file: str = "", count: int = 1) -> List[str]:
+    """
+    One bgm per variant of a task, random songs are different as long as there are enough of them.
+    """
+    if bgm_type == "random" and not (bgm_file and os.path.exists(bgm_file)):
+        files = bgm.list_songs()
+        random.shuffle(files)
+        if files:
+            return [files[i % len(files)] for i in range(count)]
+    return [get_bgm_file(bgm_type=bgm_type, bgm_file=bgm_file)] * count
+
+
+def get_output_format(video_aspect: VideoAspect, video_quality: VideoQuality = VideoQuality.full):
+    """
+    (width, height, fps) of the output video
+    """
+    width, height = VideoAspect(video_aspect).to_resolution()
+    return VideoQuality(video_quality or VideoQuality.full.value).to_format(width, height)
+
+
 def combine_videos(combined_video_path: str,
-                   video_paths: List[str],
+                   video_paths: List[str | MaterialClip],
                    audio_duration: float,
                    video_aspect: VideoAspect = VideoAspect.portrait,
-                   threads: int = 2,
+                   threads: int = 0,
+                   video_quality: VideoQuality = VideoQuality.full,
+                   encoder_profile: str = "",
+                   reporter: RenderReporter = None,
                    ) -> str:
     output_dir = os.path.dirname(combined_video_path)
 
-    aspect = VideoAspect(video_aspect)
-    video_width, video_height = aspect.to_resolution()
+    video_width, video_height, fps = get_output_format(video_aspect, video_quality)
+
+    # previews always render from the cached low resolution proxies
+    use_mezzanine = config.app.get("mezzanine_cache", True) or video_quality == VideoQuality.preview.value
 
     clips = []
     video_duration = 0
-    # Add downloaded clips over and over until the duration of the audio (max_duration) has been reached
-    for video_path in video_paths:
-        clip = VideoFileClip(video_path).without_audio()
-        clip = clip.set_fps(30)
-
-        # Not all videos are same size, so we need to resize them
-        clip_w, clip_h = clip.size
-        if clip_w != video_width or clip_h != video_height:
-            clip_ratio = clip.w / clip.h
-            video_ratio = video_width / video_height
-
-            if clip_ratio == video_ratio:
-                # 等比例缩放
-                clip = clip.resize((video_width, video_height))
-            else:
-                # 等比缩放视频
-                if clip_ratio > video_ratio:
-                    # 按照目标宽度等比缩放
-                    scale_factor = video_width / clip_w
+    # every reader is closed when the combined video is written, even on errors
+    with ExitStack() as stack:
+        # Add downloaded clips over and over until the duration of the audio (max_duration) has been reached
+        for video_path in video_paths:
+            if not isinstance(video_path, MaterialClip):
+                _clip = MaterialClip()
+                _clip.path = video_path
+                video_path = _clip
+
+            source_path = video_path.path
+            if use_mezzanine:
+                try:
+                    # already scaled and padded to the target size, so the resizing below is skipped
+                    source_path = mezzanine.get_normalized_video(source_path, video_width, video_height, fps)
+                except Exception as e:
+                    logger.warning(f"failed to normalize video, resizing it on the fly: {str(e)}")
+
+            clip = stack.enter_context(readers.open_clip(source_path))
+            if video_path.start or video_path.end:
+                # the clip was not trimmed on download, apply its in/out points here
+                clip = clip.subclip(video_path.start, min(video_path.end or clip.duration, clip.duration))
+            if abs((clip.fps or 0) - fps) > 0.01:
+                # frames are resampled once, when the combined video is written
+                clip = clip.set_fps(fps)
+
+            # Not all videos are same size, so we need to resize them
+            clip_w, clip_h = clip.size
+            if clip_w != video_width or clip_h != video_height:
+                clip_ratio = clip.w / clip.h
+                video_ratio = video_width / video_height
+
+                if clip_ratio == video_ratio:
+                    # 等比例缩放
+                    clip = clip.resize((video_width, video_height))
                 else:
-                    # 按照目标高度等比缩放
-                    scale_factor = video_height / clip_h
-
-                new_width = int(clip_w * scale_factor)
-                new_height = int(clip_h * scale_factor)
-                clip_resized = clip.resize(newsize=(new_width, new_height))
-
-                background = ColorClip(size=(video_width, video_height), color=(0, 0, 0))
-                clip = CompositeVideoClip([
-                    background.set_duration(clip.duration),
-                    clip_resized.set_position("center")
-                ])
-
-            logger.info(f"resizing video to {video_width} x {video_height}, clip size: {clip_w} x {clip_h}")
-
-        clips.append(clip)
-        video_duration += clip.duration
-        logger.info(f"video_duration {video_duration, audio_duration}")
-
-    final_clip = concatenate_videoclips(clips)
-    final_clip = final_clip.set_fps(30)
-    logger.info(f"writing")
-    final_clip.write_videofile(filename=combined_video_path,
-                               threads=threads,
-                               logger=None,
-                               temp_audiofile_path=output_dir,
-                               audio_codec="aac",
-                               fps=30,
-                               )
+                    # 等比缩放视频
+                    if clip_ratio > video_ratio:
+                        # 按照目标宽度等比缩放
+                        scale_factor = video_width / clip_w
+                    else:
+                        # 按照目标高度等比缩放
+                        scale_factor = video_height / clip_h
+
+                    new_width = int(clip_w * scale_factor)
+                    new_height = int(clip_h * scale_factor)
+                    clip_resized = clip.resize(newsize=(new_width, new_height))
+
+                    background = ColorClip(size=(video_width, video_height), color=(0, 0, 0))
+                    clip = CompositeVideoClip([
+                        background.set_duration(clip.duration),
+                        clip_resized.set_position("center")
+                    ])
+
+                logger.info(f"resizing video to {video_width} x {video_height}, clip size: {clip_w} x {clip_h}")
+
+            clips.append(clip)
+            video_duration += clip.duration
+            logger.info(f"video_duration {video_duration, audio_duration}")
+
+        final_clip = concatenate_videoclips(clips)
+        final_clip = final_clip.set_fps(fps)
+        logger.info(f"writing")
+        profile = encoder.get_profile(encoder_profile, video_quality)
+        final_clip.write_videofile(filename=combined_video_path,
+                                   logger=moviepy_logger(reporter, key="combine"),
+                                   temp_audiofile_path=output_dir,
+                                   audio_codec="aac",
+                                   fps=fps,
+                                   **encoder.moviepy_args(profile, threads or encoder.get_threads()),
+                                   )
     logger.success(f"completed")
     return combined_video_path
 
 
 def wrap_text(text, max_width, font='Arial', fontsize=60):
-    # 创建字体对象
-    font = ImageFont.truetype(font, fontsize)
-
-    def get_text_size(inner_text):
-        inner_text = inner_text.strip()
-        left, top, right, bottom = font.getbbox(inner_text)
-        return right - left, bottom - top
-
-    width, height = get_text_size(text)
-    if width <= max_width:
-        return text, height
-
-    # logger.warning(f"wrapping text, max_width: {max_width}, text_width: {width}, text: {text}")
-
-    processed = True
-
-    _wrapped_lines_ = []
-    words = text.split(" ")
-    _txt_ = ''
-    for word in words:
-        _before = _txt_
-        _txt_ += f"{word} "
-        _width, _height = get_text_size(_txt_)
-        if _width <= max_width:
-            continue
-        else:
-            if _txt_.strip() == word.strip():
-                processed = False
-                break
-            _wrapped_lines_.append(_before)
-            _txt_ = f"{word} "
-    _wrapped_lines_.append(_txt_)
-    if processed:
-        _wrapped_lines_ = [line.strip() for line in _wrapped_lines_]
-        result = '\n'.join(_wrapped_lines_).strip()
-        height = len(_wrapped_lines_) * height
-        # logger.warning(f"wrapped text: {result}")
-        return result, height
-
-    _wrapped_lines_ = []
-    chars = list(text)
-    _txt_ = ''
-    for word in chars:
-        _txt_ += word
-        _width, _height = get_text_size(_txt_)
-        if _width <= max_width:
-            continue
-        else:
-            _wrapped_lines_.append(_txt_)
-            _txt_ = ''
-    _wrapped_lines_.append(_txt_)
-    result = '\n'.join(_wrapped_lines_).strip()
-    height = len(_wrapped_lines_) * height
-    # logger.warning(f"wrapped text: {result}")
-    return result, height
+    lines, height = textrender.layout(text, max_width=max_width, font_path=font, font_size=fontsize)
+    result = '\n'.join(lines).strip()
+    return result, len(lines) * height
+
+
+def get_font_path(params: VideoParams) -> str:
+    if not params.font_name:
+        params.font_name = "STHeitiMedium.ttc"
+    font_path = os.path.join(utils.font_dir(), params.font_name)
+    if os.name == 'nt':
+        font_path = font_path.replace("\\", "/")
+    return font_path
 
 
 def generate_video(video_path: str,
@@ -155,9 +158,13 @@ def generate_video(video_path: str,
                    subtitle_path: str,
                    output_file: str,
                    params: VideoParams,
+                   bgm_file: str = None,
+                   reporter: RenderReporter = None,
                    ):
-    aspect = VideoAspect(params.video_aspect)
-    video_width, video_height = aspect.to_resolution()
+    video_width, video_height, fps = get_output_format(params.video_aspect, params.video_quality)
+    # subtitles keep the same proportions at lower resolutions
+    text_scale = video_height / VideoAspect(params.video_aspect).to_resolution()[1]
+    font_size = max(int(params.font_size * text_scale), 1)
 
     logger.info(f"start, video size: {video_width} x {video_height}")
     logger.info(f"  ① video: {video_path}")
@@ -169,74 +176,69 @@ def generate_video(video_path: str,
 
     font_path = ""
     if params.subtitle_enabled:
-        if not params.font_name:
-            params.font_name = "STHeitiMedium.ttc"
-        font_path = os.path.join(utils.font_dir(), params.font_name)
-        if os.name == 'nt':
-            font_path = font_path.replace("\\", "/")
-
+        font_path = get_font_path(params)
         logger.info(f"using font: {font_path}")
 
-    def create_text_clip(subtitle_item):
+    def create_text_overlay(subtitle_item, track: overlay.OverlayTrack):
         phrase = subtitle_item[1]
         max_width = video_width * 0.9
         wrapped_txt, txt_height = wrap_text(phrase,
                                             max_width=max_width,
                                             font=font_path,
-                                            fontsize=params.font_size
+                                            fontsize=font_size
                                             )
-        _clip = TextClip(
+        rgba = textrender.render_text(
             wrapped_txt,
-            font=font_path,
-            fontsize=params.font_size,
-            color=params.text_fore_color,
-            bg_color=params.text_background_color,
+            font_path=font_path,
+            font_size=font_size,
+            fore_color=params.text_fore_color,
+            background_color=params.text_background_color,
             stroke_color=params.stroke_color,
-            stroke_width=params.stroke_width,
-            print_cmd=False,
+            stroke_width=params.stroke_width * text_scale,
         )
-        duration = subtitle_item[0][1] - subtitle_item[0][0]
-        _clip = _clip.set_start(subtitle_item[0][0])
-        _clip = _clip.set_end(subtitle_item[0][1])
-        _clip = _clip.set_duration(duration)
+        txt_h, txt_w = rgba.shape[:2]
+        x = (video_width - txt_w) / 2
         if params.subtitle_position == "bottom":
-            _clip = _clip.set_position(('center', video_height * 0.95 - _clip.h))
+            y = video_height * 0.95 - txt_h
         elif params.subtitle_position == "top":
-            _clip = _clip.set_position(('center', video_height * 0.1))
+            y = video_height * 0.1
         else:
-            _clip = _clip.set_position(('center', 'center'))
-        return _clip
-
-    video_clip = VideoFileClip(video_path)
-    audio_clip = AudioFileClip(audio_path).volumex(params.voice_volume)
-
-    if subtitle_path and os.path.exists(subtitle_path):
-        sub = SubtitlesClip(subtitles=subtitle_path, encoding='utf-8')
-        text_clips = []
-        for item in sub.subtitles:
-            clip = create_text_clip(subtitle_item=item)
-            text_clips.append(clip)
-        video_clip = CompositeVideoClip([video_clip, *text_clips])
-
-    bgm_file = get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
-    if bgm_file:
+            y = (video_height - txt_h) / 2
+        track.add(rgba, x=x, y=y, start=subtitle_item[0][0], end=subtitle_item[0][1])
+
+    # the combined video is read once, its reader is closed right after the encode
+    with readers.open_clip(video_path, keep=False) as video_clip:
+        if subtitle_path and os.path.exists(subtitle_path):
+            sub = SubtitlesClip(subtitles=subtitle_path, encoding='utf-8')
+            subtitle_track = overlay.OverlayTrack()
+            for item in sub.subtitles:
+                create_text_overlay(subtitle_item=item, track=subtitle_track)
+            # only the subtitle active at time t is blended into the frame
+            video_clip = video_clip.fl(lambda gf, t: subtitle_track.composite(gf(t), t))
+
+        if bgm_file is None:
+            bgm_file = get_bgm_file(bgm_type=params.bgm_type, bgm_file=params.bgm_file)
+        audio_tracks = [EdlAudioTrack(kind="voice", source=audio_path, volume=params.voice_volume)]
+        if bgm_file:
+            audio_tracks.append(EdlAudioTrack(kind="bgm", source=bgm_file, volume=params.bgm_volume, loop=True, fade_out=3))
+        # the audio is mixed once, out of the frame loop, and cached for the re-renders of the same audio
+        audio_file = audio.render_tracks(audio_tracks, video_clip.duration)
+
+        profile = encoder.get_profile(params.encoder_profile, params.video_quality)
+        temp_file = os.path.join(output_dir, f"{os.path.splitext(os.path.basename(output_file))[0]}-video.mp4")
         try:
-            bgm_clip = (AudioFileClip(bgm_file)
-                        .volumex(params.bgm_volume)
-                        .audio_fadeout(3))
-            bgm_clip = afx.audio_loop(bgm_clip, duration=video_clip.duration)
-            audio_clip = CompositeAudioClip([audio_clip, bgm_clip])
-        except Exception as e:
-            logger.error(f"failed to add bgm: {str(e)}")
-
-    video_clip = video_clip.set_audio(audio_clip)
-    video_clip.write_videofile(output_file,
-                               audio_codec="aac",
-                               temp_audiofile_path=output_dir,
-                               threads=params.n_threads or 2,
-                               logger=None,
-                               fps=30,
-                               )
+            video_clip.write_videofile(temp_file if audio_file else output_file,
+                                       audio=False,
+                                       logger=moviepy_logger(reporter, key="generate"),
+                                       fps=fps,
+                                       **encoder.moviepy_args(profile, params.n_threads or encoder.get_threads()),
+                                       )
+            if audio_file:
+                ffmpeg.run(["-i", temp_file, "-i", audio_file, "-map", "0:v", "-map", "1:a", "-c", "copy",
+                            "-t", f"{video_clip.duration:.3f}", "-movflags", "+faststart", output_file])
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
 
     logger.success(f"completed")
 
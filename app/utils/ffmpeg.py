@@ -0,0 +1,115 @@
+import functools
+import os
+import re
+import subprocess
+from typing import Callable, List
+
+from loguru import logger
+
+
+def get_exe() -> str:
+    # honors IMAGEIO_FFMPEG_EXE, which is set from `ffmpeg_path` in config.toml
+    import imageio_ffmpeg
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+
+def run(args: List[str], on_progress: Callable[[int], None] = None):
+    """
+    Run ffmpeg to completion, `on_progress` is called with the number of frames encoded so far.
+    """
+    if on_progress is None:
+        cmd = [get_exe(), "-hide_banner", "-nostdin", "-loglevel", "error", "-y", *args]
+        logger.debug(f"ffmpeg: {' '.join(cmd)}")
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            err = result.stderr.decode("utf-8", errors="ignore").strip()
+            raise RuntimeError(f"ffmpeg failed ({result.returncode}): {err}")
+        return
+
+    # key=value blocks on stdout, about twice per second
+    process = popen(["-progress", "pipe:1", "-nostats", *args], stdout=subprocess.PIPE)
+    for line in process.stdout:
+        key, _, value = line.decode("utf-8", errors="ignore").strip().partition("=")
+        if key == "frame" and value.isdigit():
+            on_progress(int(value))
+    process.stdout.close()
+    wait(process)
+
+
+def popen(args: List[str], stdin=None, stdout=None) -> subprocess.Popen:
+    """
+    Start ffmpeg without waiting for it, e.g. to stream raw frames through its stdin or stdout.
+    """
+    # -nostdin only when stdin doesn't carry data
+    cmd = [get_exe(), "-hide_banner", *(["-nostdin"] if stdin is None else []), "-loglevel", "error", "-y", *args]
+    logger.debug(f"ffmpeg: {' '.join(cmd)}")
+    return subprocess.Popen(cmd, stdin=stdin, stdout=stdout, stderr=subprocess.PIPE)
+
+
+def wait(process: subprocess.Popen):
+    if process.stdin:
+        process.stdin.close()
+    err = process.stderr.read().decode("utf-8", errors="ignore").strip()
+    returncode = process.wait()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg failed ({returncode}): {err}")
+
+
+def escape_filter_value(value: str) -> str:
+    # for values embedded in a filtergraph, e.g. subtitles=filename='...'
+    value = value.replace("\\", "/")
+    return value.replace(":", "\\:").replace("'", "\\'")
+
+
+@functools.lru_cache(maxsize=1024)
+def _probe(file_path: str, size: int, mtime: float) -> dict:
+    cmd = [get_exe(), "-hide_banner", "-nostdin", "-i", file_path]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = result.stderr.decode("utf-8", errors="ignore")
+
+    info = {"duration": 0.0, "width": 0, "height": 0, "fps": 0.0, "pix_fmt": "", "codec": "", "has_audio": False}
+    m = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", output)
+    if m:
+        info["duration"] = int(m.group(1)) * 3600 + int(m.group(2)) * 60 + float(m.group(3))
+
+    for line in output.splitlines():
+        if "Stream #" not in line:
+            continue
+        if " Audio: " in line:
+            info["has_audio"] = True
+        elif " Video: " in line and not info["codec"]:
+            m = re.search(r"Video: ([^\s,]+)[^,]*, ([a-z0-9_]+)(?:\([^)]*\))?, (\d+)x(\d+)", line)
+            if m:
+                info["codec"] = m.group(1)
+                info["pix_fmt"] = m.group(2)
+                info["width"] = int(m.group(3))
+                info["height"] = int(m.group(4))
+            m = re.search(r"([\d.]+) fps", line) or re.search(r"([\d.]+) tbr", line)
+            if m:
+                info["fps"] = float(m.group(1))
+    return info
+
+
+def probe(file_path: str) -> dict:
+    """
+    Duration, size, frame rate and pixel format of a media file, parsed from `ffmpeg -i`.
+    """
+    stat = os.stat(file_path)
+    return dict(_probe(os.path.abspath(file_path), stat.st_size, stat.st_mtime))
+
+
+def negotiate(file_path: str, width: int, height: int, fps: float, pix_fmt: str = "yuv420p") -> dict:
+    """
+    The conversions a video needs to match the target format, all False means it can pass through as is.
+    Unknown properties are converted.
+    """
+    try:
+        info = probe(file_path)
+    except Exception as e:
+        logger.warning(f"failed to probe video: {file_path} => {str(e)}")
+        info = {}
+    return {
+        "scale": (info.get("width"), info.get("height")) != (width, height),
+        "fps": abs(info.get("fps", 0) - fps) > 0.01,
+        "pix_fmt": info.get("pix_fmt") != pix_fmt,
+    }
@@ -2,7 +2,9 @@ import locale
 import os
 import platform
 import threading
+from contextlib import contextmanager
 from typing import Any
+from filelock import FileLock
 from loguru import logger
 import json
 from uuid import uuid4
@@ -74,6 +76,19 @@ def storage_dir(sub_dir: str = ""):
     return d
 
 
+def cache_dir(config_key: str, sub_dir: str) -> str:
+    """
+    A cache directory: the `config_key` of the [app] config, defaults to ./storage/<sub_dir>, created if missing.
+    """
+    from app.config import config
+    d = config.app.get(config_key, "").strip()
+    if not d:
+        d = storage_dir(sub_dir)
+    if not os.path.exists(d):
+        os.makedirs(d, exist_ok=True)
+    return d
+
+
 def resource_dir(sub_dir: str = ""):
     d = os.path.join(root_dir(), "resource")
     if sub_dir:
@@ -192,6 +207,35 @@ def md5(text):
     return hashlib.md5(text.encode('utf-8')).hexdigest()
 
 
+_flight_locks = {}
+_flight_locks_guard = threading.Lock()
+
+
+@contextmanager
+def single_flight(key: str, lock_file: str = ""):
+    """
+    Serialize the producers of one artifact: threads of this process wait on an in-process lock,
+    other processes on the node wait on `lock_file` (if given). Callers must re-check whether the
+    artifact already exists after entering the block.
+    """
+    with _flight_locks_guard:
+        entry = _flight_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+
+    try:
+        with entry[0]:
+            if lock_file:
+                with FileLock(lock_file):
+                    yield
+            else:
+                yield
+    finally:
+        with _flight_locks_guard:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                _flight_locks.pop(key, None)
+
+
 def get_system_locale():
     try:
         loc = locale.getdefaultlocale()
@@ -25,11 +25,14 @@ st.set_page_config(page_title="MoneyPrinter-AiSearch",
                    initial_sidebar_state="auto",
                    )
 
-from app.models.schema import VideoParams, VideoAspect, VideoConcatMode
-from app.services import task as tm, llm, voice
+from app.models.schema import VideoParams, VideoAspect, VideoConcatMode, VideoQuality
+from app.services import task as tm, llm, voice, bgm
 from app.utils import utils
 from app.config import config
 
+# analyze the bgm library in the background, before the first task picks a song
+bgm.warm_up()
+
 hide_streamlit_style = """
 <style>#root > div:nth-child(1) > div > div > div > div > section > div {padding-top: 0rem;}</style>
 """
@@ -299,9 +302,21 @@ with right_panel:
                                       )
         params.video_aspect = VideoAspect(video_aspect_ratios[selected_index][1])
 
+        # drafts are rendered as previews, the full quality render has to be chosen explicitly
+        video_qualities = [
+            (tr("Preview"), VideoQuality.preview.value),
+            (tr("Full Quality"), VideoQuality.full.value),
+        ]
+        selected_index = st.selectbox(tr("Video Quality"),
+                                      index=0,
+                                      options=range(len(video_qualities)),  # 使用索引作为内部选项值
+                                      format_func=lambda x: video_qualities[x][0]  # 显示给用户的是标签
+                                      )
+        params.video_quality = VideoQuality(video_qualities[selected_index][1])
+
         # params.video_clip_duration = st.selectbox(tr("Clip Duration"), options=[2, 3, 4, 5, 6], index=1)
-        # params.video_count = st.selectbox(tr("Number of Videos Generated Simultaneously"), options=[1, 2, 3, 4, 5],
-        #                                   index=0)
+        params.video_count = st.selectbox(tr("Number of Videos Generated Simultaneously"), options=[1, 2, 3, 4, 5],
+                                          index=0)
     with st.container(border=True):
         st.write(tr("Audio Settings"))
         voices = voice.get_all_voices(filter_locals=["zh-CN", "zh-HK", "zh-TW", "de-DE", "en-US"])